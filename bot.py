@@ -1,4 +1,6 @@
+import json
 import os
+from collections import deque
 from dotenv import load_dotenv
 from loguru import logger
 
@@ -31,7 +33,10 @@ from typing import Optional, List
 from pipecat.frames.frames import TranscriptionMessage, TranscriptionUpdateFrame
 from pipecat.processors.transcript_processor import TranscriptProcessor
 from pipecat.frames.frames import LLMMessagesFrame, TTSSpeakFrame, TTSStoppedFrame
-from turn_client import CustomSmartTurnAnalyzer
+from turn_client import CustomSmartTurnAnalyzer, LocalSmartTurnAnalyzer
+from turn_controller import AdaptiveTurnController
+from capture import CallRecorder
+from call_memory import CallMemory, check_call_budget, register_call
 from pipecat.metrics.metrics import SmartTurnMetricsData
 from pipecat.adapters.schemas.function_schema import FunctionSchema
 from pipecat.adapters.schemas.tools_schema import ToolsSchema
@@ -43,6 +48,12 @@ from pathlib import Path
 load_dotenv(override=True)
 
 RECORDS_DIR = "records"
+CAPTURES_DIR = RECORDS_DIR + "/captures"
+
+# Serialized size the LLM context is trimmed to, oldest turns are dropped first
+CONTEXT_BUDGET_BYTES = int(os.getenv("CONTEXT_BUDGET_BYTES", str(64 * 1024)))
+# Transcript messages kept in memory, the full transcript is in the output file
+TRANSCRIPT_RECENT_MESSAGES = 20
 
 SYSTEM_PROMPT = """
 Your name is Budiono, act as a person who is friendly.
@@ -104,7 +115,8 @@ class SmartTurnMetricsProcessor(FrameProcessor):
 
 class TranscriptHandler:
     def __init__(self, output_file: Optional[str] = None):
-        self.messages: List[TranscriptionMessage] = []
+        self.messages: deque = deque(maxlen=TRANSCRIPT_RECENT_MESSAGES)
+        self.message_count = 0
         self.output_file: Optional[str] = output_file
         logger.debug(
             f"TranscriptHandler initialized {'with output_file=' + output_file if output_file else 'with log output only'}"
@@ -132,53 +144,70 @@ class TranscriptHandler:
         logger.debug(f"Received transcript update with {len(frame.messages)} new messages")
         for msg in frame.messages:
             self.messages.append(msg)
+            self.message_count += 1
             await self.save_message(msg)
 
+    def memory_bytes(self) -> int:
+        return sum(len(msg.content) for msg in self.messages)
 
-async def run_bot(webrtc_connection):
-    logger.info(f"Starting bot")
 
-    md_filter = MarkdownTextFilter(
-        params=MarkdownTextFilter.InputParams(
-            filter_code=True,
-            filter_tables=True
-        )
-    )
+def trim_context(context: OpenAILLMContext, max_bytes: int = CONTEXT_BUDGET_BYTES) -> int:
+    """Drop the oldest messages until the context fits in `max_bytes`.
 
-    transport = SmallWebRTCTransport(
-        webrtc_connection=webrtc_connection,
-        params=TransportParams(
-            audio_in_filter=NoisereduceFilter(),
-            audio_in_enabled=True,
-            audio_out_enabled=True,
-            vad_analyzer=SileroVADAnalyzer(params=VADParams(stop_secs=0.5)),
-            turn_analyzer=CustomSmartTurnAnalyzer(
-                aiohttp_session=aiohttp.ClientSession(),
-                base_url=os.getenv("BASE_URL_STT"),
-            )
-        ),
-    )
+    The first message (the system prompt) and the latest message are always
+    kept. The list is trimmed in place since the pipeline holds on to it.
+    Returns the number of messages dropped.
+    """
+    messages = context.get_messages()
+    sizes = [len(json.dumps(message, default=str)) for message in messages]
+    total = sum(sizes)
+
+    start = 1
+    while total > max_bytes and start < len(messages) - 1:
+        total -= sizes[start]
+        start += 1
+    # Don't keep tool results whose function call was dropped
+    while (
+        start > 1
+        and start < len(messages) - 1
+        and isinstance(messages[start], dict)
+        and messages[start].get("role") == "tool"
+    ):
+        start += 1
 
-    stt = CustomSTTService(
-        base_url=os.getenv("BASE_URL_STT"),
-        model="dummy",
-        api_key="dummy",
-    )
+    if start > 1:
+        del messages[1:start]
+    return start - 1
 
-    llm = CustomLLMService(
-        base_url=os.getenv("BASE_URL_LLM"),
-        model="dummy",
-        api_key="dummy",
-    )
 
-    tts = CustomTTSService(
-        base_url=os.getenv("BASE_URL_TTS"),
-        model="dummy",
-        api_key="dummy",
-        text_filters=[md_filter]
+def create_vad_analyzer() -> SileroVADAnalyzer:
+    return SileroVADAnalyzer(params=VADParams(stop_secs=0.5))
+
+
+def create_transport_params(vad_analyzer, turn_analyzer) -> TransportParams:
+    return TransportParams(
+        audio_in_filter=NoisereduceFilter(),
+        audio_in_enabled=True,
+        audio_out_enabled=True,
+        vad_analyzer=vad_analyzer,
+        turn_analyzer=turn_analyzer,
     )
 
 
+def create_pipeline_task(
+    transport,
+    stt,
+    llm,
+    tts,
+    transcript_file: Optional[str] = None,
+    observers: Optional[List] = None,
+    call_memory: Optional[CallMemory] = None,
+) -> PipelineTask:
+    """Build the call pipeline and register its event handlers.
+
+    Shared by `run_bot` and the offline replay runner so both exercise the
+    exact same processors.
+    """
     # RTVI events for Pipecat client UI
     rtvi = RTVIProcessor(config=RTVIConfig(config=[]))
 
@@ -243,11 +272,7 @@ async def run_bot(webrtc_connection):
     context_aggregator = llm.create_context_aggregator(context)
 
     transcript = TranscriptProcessor()
-    # Create filename with voice name and timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{timestamp}.log"
-    file_path = RECORDS_DIR + "/" + filename
-    transcript_handler = TranscriptHandler(output_file=file_path) # Output to file and log
+    transcript_handler = TranscriptHandler(output_file=transcript_file) # Output to file and log
 
     pipeline = Pipeline(
         [
@@ -273,7 +298,7 @@ async def run_bot(webrtc_connection):
             enable_metrics=True,
             enable_usage_metrics=True,
         ),
-        observers=[RTVIObserver(rtvi)],
+        observers=[RTVIObserver(rtvi)] + (observers or []),
     )
 
 
@@ -299,6 +324,8 @@ async def run_bot(webrtc_connection):
     @transport.event_handler("on_client_disconnected")
     async def on_client_disconnected(transport, client):
         logger.info("Client disconnected")
+        # The WebRTC transport reports a closed connection as a disconnect
+        await task.cancel()
 
     @transport.event_handler("on_client_closed")
     async def on_client_closed(transport, client):
@@ -308,7 +335,130 @@ async def run_bot(webrtc_connection):
     @transcript.event_handler("on_transcript_update")
     async def on_transcript_update(processor, frame):
         await transcript_handler.on_transcript_update(processor, frame)
+        dropped = trim_context(context)
+        if dropped:
+            logger.debug(f"Dropped {dropped} old messages from the LLM context")
+        if call_memory:
+            check_call_budget(call_memory)
+
+    if call_memory:
+        call_memory.track("transport", transport)
+        call_memory.track("stt", stt)
+        call_memory.track("llm", llm)
+        call_memory.track("tts", tts)
+        call_memory.track("turn_analyzer", transport.input().turn_analyzer)
+        call_memory.track("llm_context", context)
+        call_memory.track("transcript_handler", transcript_handler)
+        call_memory.track("pipeline_task", task)
+
+    return task
+
+
+async def close_call_clients(stt, llm, tts, aiohttp_session: Optional[aiohttp.ClientSession] = None):
+    """Close the HTTP clients of a finished call so their connections are released."""
+    for service in (stt, llm, tts):
+        try:
+            await service._client.close()
+        except Exception as e:
+            logger.warning(f"Error closing {service} client: {e}")
+    if aiohttp_session:
+        await aiohttp_session.close()
+
+
+async def run_bot(webrtc_connection):
+    logger.info(f"Starting bot")
 
-    runner = PipelineRunner(handle_sigint=True)
+    md_filter = MarkdownTextFilter(
+        params=MarkdownTextFilter.InputParams(
+            filter_code=True,
+            filter_tables=True
+        )
+    )
+
+    vad_analyzer = create_vad_analyzer()
+
+    # Learns the caller's pauses to tune VAD stop time and skip turn-detect requests
+    turn_controller = None
+    if os.getenv("ADAPTIVE_TURN", "1") == "1":
+        turn_controller = AdaptiveTurnController(vad_analyzer=vad_analyzer)
+
+    # Run smart-turn in process when a model is configured, the turn-detect
+    # endpoint stays as the fallback
+    aiohttp_session = aiohttp.ClientSession()
+    turn_analyzer_args = dict(
+        aiohttp_session=aiohttp_session,
+        base_url=os.getenv("BASE_URL_STT"),
+        turn_controller=turn_controller,
+        call_id=webrtc_connection.pc_id,
+    )
+    if os.getenv("SMART_TURN_MODEL_PATH"):
+        turn_analyzer = LocalSmartTurnAnalyzer(
+            model_path=os.getenv("SMART_TURN_MODEL_PATH"), **turn_analyzer_args
+        )
+    else:
+        turn_analyzer = CustomSmartTurnAnalyzer(**turn_analyzer_args)
+
+    transport = SmallWebRTCTransport(
+        webrtc_connection=webrtc_connection,
+        params=create_transport_params(vad_analyzer, turn_analyzer),
+    )
+
+    stt = CustomSTTService(
+        base_url=os.getenv("BASE_URL_STT"),
+        model="dummy",
+        api_key="dummy",
+        call_id=webrtc_connection.pc_id,
+    )
+
+    llm = CustomLLMService(
+        base_url=os.getenv("BASE_URL_LLM"),
+        model="dummy",
+        api_key="dummy",
+        call_id=webrtc_connection.pc_id,
+    )
+
+    tts = CustomTTSService(
+        base_url=os.getenv("BASE_URL_TTS"),
+        model="dummy",
+        api_key="dummy",
+        text_filters=[md_filter],
+        call_id=webrtc_connection.pc_id,
+    )
+
+    # Create filename with voice name and timestamp
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{timestamp}.log"
+    file_path = RECORDS_DIR + "/" + filename
+
+    # Optionally capture the call so it can be replayed offline (see replay.py)
+    recorder = None
+    if os.getenv("CAPTURE_CALLS", "0") == "1":
+        recorder = CallRecorder(
+            Path(CAPTURES_DIR) / f"{timestamp}_{webrtc_connection.pc_id}",
+            transport=transport,
+            stt=stt,
+            llm=llm,
+            tts=tts,
+        )
+
+    task = create_pipeline_task(
+        transport,
+        stt,
+        llm,
+        tts,
+        transcript_file=file_path,
+        observers=[recorder] if recorder else None,
+        call_memory=register_call(webrtc_connection.pc_id),
+    )
 
-    await runner.run(task)
+    # The server owns SIGINT/SIGTERM, they start a drain of all calls
+    runner = PipelineRunner(handle_sigint=False)
+
+    try:
+        await runner.run(task)
+    finally:
+        if recorder:
+            recorder.close()
+        if turn_controller:
+            logger.info(f"Adaptive turn report: {turn_controller.report()}")
+        await close_call_clients(stt, llm, tts, aiohttp_session)
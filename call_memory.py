@@ -0,0 +1,216 @@
+"""Per-call memory accounting and teardown leak checks.
+
+Each call registers its large objects (transport, services, LLM context,
+transcript handler, turn analyzer, pipeline task) with a `CallMemory`. While
+the call runs, the objects' sizes are reported against a per-call budget.
+When the call ends only weak references are kept, and any object still alive
+after a garbage collection is reported as leaked.
+
+A full garbage collection stalls the event loop for every other call, so the
+server only marks calls as closed. They are checked when the memory report is
+requested, the replay tools check every call right away.
+"""
+
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+# Soft memory budget of a single call
+CALL_MEMORY_BUDGET_BYTES = int(os.getenv("CALL_MEMORY_BUDGET_BYTES", str(4 * 1024 * 1024)))
+# Number of leaked calls kept for inspection
+MAX_LEAKED_CALLS = 100
+# Number of closed calls kept until the next teardown check
+MAX_CLOSED_CALLS = 1000
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No procfs (macOS), fall back to the peak RSS, reported in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def object_bytes(obj: Any) -> int:
+    """Approximate number of bytes held by a call object.
+
+    Objects that know what they buffer implement `memory_bytes()`, LLM contexts
+    are measured by their serialized messages, anything else by its shallow size.
+    """
+    if hasattr(obj, "memory_bytes"):
+        return obj.memory_bytes()
+    if hasattr(obj, "get_messages"):
+        return len(json.dumps(obj.get_messages(), default=str))
+    return sys.getsizeof(obj)
+
+
+class CallMemory:
+    """Tracks the objects of one call through weak references."""
+
+    def __init__(self, call_id: str):
+        self.call_id = call_id
+        self.closed_at: Optional[float] = None
+        self._objects: Dict[str, weakref.ref] = {}
+
+    def track(self, name: str, obj: Any):
+        self._objects[name] = weakref.ref(obj)
+
+    def alive(self) -> Dict[str, Any]:
+        objects = {}
+        for name, ref in self._objects.items():
+            obj = ref()
+            if obj is not None:
+                objects[name] = obj
+        return objects
+
+    def usage(self) -> Dict[str, int]:
+        usage = {}
+        for name, obj in self.alive().items():
+            try:
+                usage[name] = object_bytes(obj)
+            except Exception as e:
+                logger.debug(f"Error measuring {name} of call {self.call_id}: {e}")
+        return usage
+
+
+class AudioBufferPool:
+    """Fixed-size audio buffers reused across calls instead of reallocated."""
+
+    def __init__(self, max_pooled: int = 32):
+        self._max_pooled = max_pooled
+        self._free: Dict[int, list] = {}
+
+    def acquire(self, size: int) -> bytearray:
+        free = self._free.get(size)
+        if free:
+            return free.pop()
+        return bytearray(size)
+
+    def release(self, buffer: bytearray):
+        free = self._free.setdefault(len(buffer), [])
+        if len(free) < self._max_pooled:
+            free.append(buffer)
+
+    def pooled_bytes(self) -> int:
+        return sum(size * len(free) for size, free in self._free.items())
+
+
+AUDIO_BUFFER_POOL = AudioBufferPool()
+
+_active_calls: Dict[str, CallMemory] = {}
+_closed_calls: "OrderedDict[str, CallMemory]" = OrderedDict()
+_leaked_calls: "OrderedDict[str, CallMemory]" = OrderedDict()
+_leaked_calls_total = 0
+
+
+def register_call(call_id: str) -> CallMemory:
+    call = CallMemory(call_id)
+    _active_calls[call_id] = call
+    return call
+
+
+def check_call_budget(call: CallMemory):
+    total = sum(call.usage().values())
+    if total > CALL_MEMORY_BUDGET_BYTES:
+        logger.warning(
+            f"Call {call.call_id} uses {total} bytes, over the budget of {CALL_MEMORY_BUDGET_BYTES}"
+        )
+
+
+def close_call(call_id: str):
+    """Mark a call as finished, its objects are checked by `check_closed_calls`.
+
+    Must be called once the code running the call has returned, so its local
+    references are gone. Doesn't collect garbage, it is cheap enough to call at
+    the end of every call.
+    """
+    call = _active_calls.pop(call_id, None)
+    if not call:
+        return
+    call.closed_at = time.time()
+    _closed_calls[call_id] = call
+
+    # Calls freed by reference counting need no check
+    for closed_id, closed in list(_closed_calls.items()):
+        if not closed.alive():
+            del _closed_calls[closed_id]
+    while len(_closed_calls) > MAX_CLOSED_CALLS:
+        _closed_calls.popitem(last=False)
+
+
+def check_closed_calls() -> Dict[str, Dict[str, int]]:
+    """Collect garbage and report the closed calls with objects still alive.
+
+    Blocks for as long as a full garbage collection takes, so don't run it on
+    a busy event loop for every call. Returns the leaked objects and their
+    sizes by call.
+    """
+    global _leaked_calls_total
+
+    if not _closed_calls:
+        return {}
+    gc.collect()
+    leaks = {}
+    while _closed_calls:
+        call_id, call = _closed_calls.popitem(last=False)
+        leaked = call.usage()
+        if not leaked:
+            continue
+        logger.warning(f"Call {call_id} leaked {sum(leaked.values())} bytes: {leaked}")
+        leaks[call_id] = leaked
+        _leaked_calls[call_id] = call
+        _leaked_calls_total += 1
+        while len(_leaked_calls) > MAX_LEAKED_CALLS:
+            _leaked_calls.popitem(last=False)
+    return leaks
+
+
+def check_call_teardown(call_id: str) -> Dict[str, int]:
+    """Close a call and check right away that nothing of it is still alive.
+
+    Runs a full garbage collection, for the replay tools. Returns the leaked
+    objects and their sizes.
+    """
+    close_call(call_id)
+    return check_closed_calls().get(call_id, {})
+
+
+def memory_report() -> Dict[str, Any]:
+    """Memory of the active calls and of the leaked ones, closed calls are checked first."""
+    check_closed_calls()
+    calls = {}
+    for call_id, call in _active_calls.items():
+        usage = call.usage()
+        calls[call_id] = {"total_bytes": sum(usage.values()), "objects": usage}
+
+    leaked = {}
+    for call_id, call in list(_leaked_calls.items()):
+        usage = call.usage()
+        if not usage:
+            # Collected since the teardown check
+            del _leaked_calls[call_id]
+            continue
+        leaked[call_id] = {
+            "closed_at": call.closed_at,
+            "total_bytes": sum(usage.values()),
+            "objects": usage,
+        }
+
+    return {
+        "rss_bytes": current_rss_bytes(),
+        "call_budget_bytes": CALL_MEMORY_BUDGET_BYTES,
+        "calls": calls,
+        "leaked_calls": leaked,
+        "leaked_calls_total": _leaked_calls_total,
+        "audio_buffer_pool_bytes": AUDIO_BUFFER_POOL.pooled_bytes(),
+    }
@@ -0,0 +1,206 @@
+"""Per-call capture of inbound audio, outbound frames and backend timings.
+
+A capture directory holds everything needed to replay a call offline with
+`replay.py`:
+
+    meta.json      call metadata
+    inbound.pcm    audio pushed by the input transport, before the audio filter
+    outbound.pcm   audio frames seen by `transport.output()`
+    events.jsonl   timestamped events, audio events reference the PCM files
+"""
+
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger
+
+from pipecat.frames.frames import (
+    FunctionCallInProgressFrame,
+    InputAudioRawFrame,
+    LLMFullResponseEndFrame,
+    LLMFullResponseStartFrame,
+    LLMTextFrame,
+    MetricsFrame,
+    OutputAudioRawFrame,
+    TranscriptionFrame,
+    TTSAudioRawFrame,
+    TTSStartedFrame,
+    TTSStoppedFrame,
+    TTSTextFrame,
+)
+from pipecat.metrics.metrics import ProcessingMetricsData, SmartTurnMetricsData, TTFBMetricsData
+from pipecat.observers.base_observer import BaseObserver, FramePushed
+from pipecat.processors.frame_processor import FrameDirection
+
+
+class CallRecorder(BaseObserver):
+    """Records a call so it can be replayed through the pipeline offline.
+
+    The recorder is a pipeline observer, so it does not change the pipeline
+    itself. Inbound audio is taken directly from the input transport, before
+    noise filtering, so replaying it exercises the same audio path.
+    """
+
+    def __init__(self, capture_dir: Path, *, transport, stt, llm, tts):
+        super().__init__()
+        self._dir = Path(capture_dir)
+        self._dir.mkdir(parents=True, exist_ok=True)
+
+        self._input = transport.input()
+        self._output = transport.output()
+        self._stt = stt
+        self._llm = llm
+        self._tts = tts
+
+        self._start_time = time.monotonic()
+        self._events = open(self._dir / "events.jsonl", "w", encoding="utf-8")
+        self._inbound = open(self._dir / "inbound.pcm", "wb")
+        self._outbound = open(self._dir / "outbound.pcm", "wb")
+        self._inbound_offset = 0
+        self._outbound_offset = 0
+        self._closed = False
+
+        with open(self._dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"started_at": datetime.now().isoformat()}, f)
+
+        # Capture raw audio before it is queued for filtering, VAD and turn analysis
+        push_audio_frame = self._input.push_audio_frame
+
+        async def _push_audio_frame(frame: InputAudioRawFrame):
+            self._record_inbound(frame)
+            await push_audio_frame(frame)
+
+        self._input.push_audio_frame = _push_audio_frame
+
+        logger.info(f"Capturing call to {self._dir}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._write_event("closed")
+        self._events.close()
+        self._inbound.close()
+        self._outbound.close()
+
+    async def on_push_frame(self, data: FramePushed):
+        if self._closed:
+            return
+
+        src = data.source
+        frame = data.frame
+
+        if isinstance(frame, MetricsFrame):
+            self._record_metrics(src, frame)
+        elif src is self._stt and isinstance(frame, TranscriptionFrame):
+            self._write_event("stt_transcription", text=frame.text)
+        elif src is self._llm and data.direction == FrameDirection.DOWNSTREAM:
+            self._record_llm(frame)
+        elif src is self._tts:
+            self._record_tts(frame)
+
+        if data.destination is self._output:
+            self._record_outbound(frame)
+
+    def _record_metrics(self, src, frame: MetricsFrame):
+        for metrics in frame.data:
+            if isinstance(metrics, SmartTurnMetricsData):
+                if src is not self._input:
+                    continue
+                self._write_event(
+                    "smart_turn",
+                    is_complete=metrics.is_complete,
+                    probability=metrics.probability,
+                    inference_time_ms=metrics.inference_time_ms,
+                    server_total_time_ms=metrics.server_total_time_ms,
+                    e2e_processing_time_ms=metrics.e2e_processing_time_ms,
+                )
+                continue
+
+            # Metrics frames are forwarded by every processor, only keep the
+            # one pushed by the service that produced them.
+            if metrics.processor != src.name:
+                continue
+            backend = {
+                self._stt.name: "stt",
+                self._llm.name: "llm",
+                self._tts.name: "tts",
+            }.get(metrics.processor)
+            if not backend:
+                continue
+            if isinstance(metrics, TTFBMetricsData):
+                self._write_event("metric", backend=backend, metric="ttfb", value=metrics.value)
+            elif isinstance(metrics, ProcessingMetricsData):
+                self._write_event(
+                    "metric", backend=backend, metric="processing", value=metrics.value
+                )
+
+    def _record_llm(self, frame):
+        if isinstance(frame, LLMFullResponseStartFrame):
+            self._write_event("llm_start")
+        elif isinstance(frame, LLMTextFrame):
+            self._write_event("llm_text", text=frame.text)
+        elif isinstance(frame, FunctionCallInProgressFrame):
+            self._write_event(
+                "llm_function_call",
+                function_name=frame.function_name,
+                tool_call_id=frame.tool_call_id,
+                arguments=frame.arguments,
+            )
+        elif isinstance(frame, LLMFullResponseEndFrame):
+            self._write_event("llm_end")
+
+    def _record_tts(self, frame):
+        if isinstance(frame, TTSStartedFrame):
+            self._write_event("tts_started")
+        elif isinstance(frame, TTSAudioRawFrame):
+            self._write_event(
+                "tts_audio",
+                size=len(frame.audio),
+                sample_rate=frame.sample_rate,
+                num_channels=frame.num_channels,
+            )
+        elif isinstance(frame, TTSStoppedFrame):
+            self._write_event("tts_stopped")
+        elif isinstance(frame, TTSTextFrame):
+            self._write_event("tts_text", text=frame.text)
+
+    def _record_inbound(self, frame: InputAudioRawFrame):
+        if self._closed:
+            return
+        self._inbound.write(frame.audio)
+        self._write_event(
+            "audio_in",
+            offset=self._inbound_offset,
+            size=len(frame.audio),
+            sample_rate=frame.sample_rate,
+            num_channels=frame.num_channels,
+        )
+        self._inbound_offset += len(frame.audio)
+
+    def _record_outbound(self, frame):
+        if isinstance(frame, InputAudioRawFrame):
+            # Passthrough of inbound audio, already captured.
+            return
+        if isinstance(frame, OutputAudioRawFrame):
+            self._outbound.write(frame.audio)
+            self._write_event(
+                "audio_out",
+                frame=type(frame).__name__,
+                offset=self._outbound_offset,
+                size=len(frame.audio),
+                sample_rate=frame.sample_rate,
+                num_channels=frame.num_channels,
+            )
+            self._outbound_offset += len(frame.audio)
+        else:
+            self._write_event("frame_out", frame=type(frame).__name__, text=getattr(frame, "text", None))
+
+    def _write_event(self, kind: str, **fields):
+        event = {"t": time.monotonic() - self._start_time, "kind": kind, **fields}
+        try:
+            self._events.write(json.dumps(event, default=str) + "\n")
+        except Exception as e:
+            logger.error(f"Error writing capture event: {e}")
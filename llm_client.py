@@ -60,6 +60,7 @@ async def _stream_chat_completions_patched(
 
 import json
 import os
+from typing import Optional
 
 from openai import AsyncStream
 from openai.types.chat import ChatCompletionChunk
@@ -70,11 +71,13 @@ from pipecat.utils.asyncio.watchdog_async_iterator import WatchdogAsyncIterator
 os.environ["GRPC_ENABLE_FORK_SUPPORT"] = "false"
 
 from loguru import logger
-from pipecat.frames.frames import LLMTextFrame
+from pipecat.frames.frames import ErrorFrame, LLMTextFrame
 from pipecat.metrics.metrics import LLMTokenUsage
 from pipecat.processors.aggregators.openai_llm_context import OpenAILLMContext
 from pipecat.services.openai.llm import OpenAILLMService
 
+from scheduler import DEADLINE_SECS, Priority, RequestShed, get_backend
+
 
 class CustomLLMService(OpenAILLMService):
     def __init__(
@@ -84,12 +87,24 @@ class CustomLLMService(OpenAILLMService):
         base_url: str = "dummy",
         model: str = "dummy",
         stream: bool = False,
+        call_id: Optional[str] = None,
         **kwargs,
     ):
         self.stream = stream
         super().__init__(api_key=api_key, base_url=base_url, model=model, **kwargs)
+        self._call_id = call_id or self.name
 
     async def _process_context(self, context: OpenAILLMContext):
+        # The slot is held until the whole completion has been read
+        try:
+            async with get_backend("llm").slot(
+                Priority.LLM, self._call_id, DEADLINE_SECS[Priority.LLM]
+            ):
+                await self._run_completion(context)
+        except RequestShed as e:
+            await self.push_error(ErrorFrame(f"LLM completion shed: {e}"))
+
+    async def _run_completion(self, context: OpenAILLMContext):
         functions_list = []
         arguments_list = []
         tool_id_list = []
@@ -0,0 +1,1188 @@
+"""Offline replay of captured calls for benchmarking the pipeline.
+
+Calls captured with `CAPTURE_CALLS=1` (see capture.py) are fed through the same
+pipeline `run_bot` builds. STT, LLM, TTS and turn-detect are replaced by mock
+backends that return the recorded responses with the recorded timing, so no
+browser or backend is needed.
+
+Usage:
+    python replay.py run records/captures/<call> [<call> ...] --speed 4 --output report.json
+    python replay.py soak records/captures/<call> --calls 2000 --concurrency 8 --speed 10
+    python replay.py webrtc-check records/captures/<call>
+    python replay.py features-check records/captures/<call>
+    python replay.py turn-compare records/captures/<call> [<call> ...] --speed 4
+    python replay.py compare baseline.json candidate.json --threshold 0.1
+
+`--speed` scales the audio feed and every mock backend delay. Timers inside
+pipecat that use the wall clock (user idle, bot speaking detection) are not
+scaled, so only compare reports produced with the same speed.
+"""
+
+import argparse
+import asyncio
+import fractions
+import json
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import av
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription
+from loguru import logger
+from openai.types.audio import Transcription
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import (
+    Choice,
+    ChoiceDelta,
+    ChoiceDeltaToolCall,
+    ChoiceDeltaToolCallFunction,
+)
+
+from bot import close_call_clients, create_pipeline_task, create_transport_params, create_vad_analyzer
+from call_memory import check_call_teardown, current_rss_bytes, memory_report, register_call
+from scheduler import scheduler_report
+from llm_client import CustomLLMService
+from stt_client import CustomSTTService
+from tts_client import CustomTTSService
+from turn_client import CustomSmartTurnAnalyzer
+from turn_controller import AdaptiveTurnController, AdaptiveTurnParams
+
+from pipecat.frames.frames import (
+    BotStartedSpeakingFrame,
+    EndFrame,
+    InputAudioRawFrame,
+    MetricsFrame,
+    OutputAudioRawFrame,
+    StartFrame,
+    TTSAudioRawFrame,
+    TTSStartedFrame,
+    TTSStoppedFrame,
+    UserStartedSpeakingFrame,
+    UserStoppedSpeakingFrame,
+)
+from pipecat.metrics.metrics import ProcessingMetricsData, SmartTurnMetricsData, TTFBMetricsData
+from pipecat.observers.base_observer import BaseObserver, FramePushed
+from pipecat.pipeline.runner import PipelineRunner
+from pipecat.processors.frame_processor import FrameDirection
+from pipecat.transports.base_input import BaseInputTransport
+from pipecat.transports.base_output import BaseOutputTransport
+from pipecat.transports.base_transport import BaseTransport, TransportParams
+from pipecat.transports.network.small_webrtc import SmallWebRTCTransport
+from pipecat.transports.network.webrtc_connection import SmallWebRTCConnection
+
+REPLAY_URL = "http://replay.invalid"
+
+# How long to wait for the audio task to stop before cancelling it again
+AUDIO_TASK_CANCEL_SECS = 0.5
+
+# A recorded turn-detect response answers a replayed request made within this
+# distance of it on the audio clock
+RESPONSE_MATCH_SECS = 1.0
+
+
+@dataclass
+class AudioChunk:
+    t: float
+    audio: bytes
+    sample_rate: int
+    num_channels: int
+
+
+@dataclass
+class Capture:
+    path: Path
+    audio: List[AudioChunk] = field(default_factory=list)
+    stt: List[Dict[str, Any]] = field(default_factory=list)
+    llm: List[Dict[str, Any]] = field(default_factory=list)
+    tts: List[Dict[str, Any]] = field(default_factory=list)
+    smart_turn: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def audio_secs(self) -> float:
+        return sum(
+            len(c.audio) / (c.sample_rate * c.num_channels * 2) for c in self.audio
+        )
+
+
+def load_capture(path: Path) -> Capture:
+    """Rebuild inbound audio and per-backend responses from a capture directory."""
+    capture = Capture(path=Path(path))
+    inbound = (capture.path / "inbound.pcm").read_bytes()
+
+    llm_response = None
+    tts_response = None
+    with open(capture.path / "events.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            event = json.loads(line)
+            kind = event["kind"]
+            t = event["t"]
+
+            if kind == "audio_in":
+                audio = inbound[event["offset"] : event["offset"] + event["size"]]
+                capture.audio.append(
+                    AudioChunk(t, audio, event["sample_rate"], event["num_channels"])
+                )
+            elif kind == "smart_turn":
+                capture.smart_turn.append(event)
+            elif kind == "metric" and event["backend"] == "stt":
+                # Whisper-style STT reports processing metrics once per request,
+                # an empty transcription produces no transcription event.
+                if event["metric"] == "processing":
+                    capture.stt.append({"text": "", "delay": event["value"]})
+            elif kind == "stt_transcription" and capture.stt:
+                capture.stt[-1]["text"] = event["text"]
+            elif kind == "llm_start":
+                llm_response = {"text": "", "function_calls": [], "ttfb": 0.0, "t": t}
+                capture.llm.append(llm_response)
+            elif kind == "llm_text" and llm_response:
+                llm_response["text"] += event["text"]
+            elif kind == "llm_function_call" and llm_response:
+                llm_response["function_calls"].append(event)
+            elif kind == "metric" and event["backend"] == "llm" and llm_response:
+                if event["metric"] == "ttfb":
+                    llm_response["ttfb"] = event["value"]
+            elif kind == "llm_end" and llm_response:
+                llm_response["duration"] = t - llm_response.pop("t")
+                llm_response = None
+            elif kind == "tts_started":
+                tts_response = {"size": 0, "ttfb": 0.0, "t": t}
+                capture.tts.append(tts_response)
+            elif kind == "tts_audio" and tts_response:
+                tts_response["size"] += event["size"]
+            elif kind == "metric" and event["backend"] == "tts" and tts_response:
+                if event["metric"] == "ttfb":
+                    tts_response["ttfb"] = event["value"]
+            elif kind == "tts_stopped" and tts_response:
+                tts_response["duration"] = t - tts_response.pop("t")
+                tts_response = None
+
+    return capture
+
+
+#
+# Mock backends
+#
+
+
+class ReplaySTTService(CustomSTTService):
+    def __init__(self, *, responses: List[Dict[str, Any]], speed: float = 1.0, **kwargs):
+        super().__init__(base_url=REPLAY_URL, **kwargs)
+        self._responses = deque(responses)
+        self._speed = speed
+
+    async def _transcribe(self, audio: bytes) -> Transcription:
+        response = self._responses.popleft() if self._responses else {"text": "", "delay": 0}
+        await asyncio.sleep(response["delay"] / self._speed)
+        return Transcription(text=response["text"])
+
+
+class ReplayLLMService(CustomLLMService):
+    def __init__(self, *, responses: List[Dict[str, Any]], speed: float = 1.0, **kwargs):
+        super().__init__(base_url=REPLAY_URL, **kwargs)
+        self._responses = deque(responses)
+        self._speed = speed
+
+    async def get_chat_completions(self, context, messages):
+        response = self._responses.popleft() if self._responses else {"text": ""}
+        return self._replay_stream(response)
+
+    async def _replay_stream(self, response: Dict[str, Any]):
+        ttfb = response.get("ttfb", 0.0)
+        duration = max(response.get("duration", ttfb), ttfb)
+
+        await asyncio.sleep(ttfb / self._speed)
+        for index, call in enumerate(response.get("function_calls", [])):
+            yield self._chunk(
+                ChoiceDelta(
+                    tool_calls=[
+                        ChoiceDeltaToolCall(
+                            index=index,
+                            id=call["tool_call_id"],
+                            type="function",
+                            function=ChoiceDeltaToolCallFunction(
+                                name=call["function_name"],
+                                arguments=json.dumps(call["arguments"] or {}),
+                            ),
+                        )
+                    ]
+                )
+            )
+        await asyncio.sleep((duration - ttfb) / self._speed)
+        if response.get("text"):
+            yield self._chunk(ChoiceDelta(content=response["text"]))
+
+    def _chunk(self, delta: ChoiceDelta) -> ChatCompletionChunk:
+        return ChatCompletionChunk(
+            id="replay",
+            object="chat.completion.chunk",
+            created=int(time.time()),
+            model="replay",
+            choices=[Choice(index=0, delta=delta, finish_reason=None)],
+        )
+
+
+class ReplayTTSService(CustomTTSService):
+    def __init__(self, *, responses: List[Dict[str, Any]], speed: float = 1.0, **kwargs):
+        super().__init__(base_url=REPLAY_URL, api_key="replay", **kwargs)
+        self._responses = deque(responses)
+        self._speed = speed
+
+    async def _synthesize(self, text: str):
+        response = self._responses.popleft() if self._responses else {"size": 0}
+        ttfb = response.get("ttfb", 0.0)
+        duration = max(response.get("duration", ttfb), ttfb)
+
+        await self.start_ttfb_metrics()
+        await asyncio.sleep(ttfb / self._speed)
+        await self.start_tts_usage_metrics(text)
+
+        yield TTSStartedFrame()
+        chunk_size = self.chunk_size
+        num_chunks = max(1, -(-response["size"] // chunk_size))
+        interval = (duration - ttfb) / self._speed / num_chunks
+        remaining = response["size"]
+        while remaining > 0:
+            size = min(chunk_size, remaining)
+            remaining -= size
+            await self.stop_ttfb_metrics()
+            yield TTSAudioRawFrame(bytes(size), self.sample_rate, 1)
+            await asyncio.sleep(interval)
+        yield TTSStoppedFrame()
+
+
+class ReplaySmartTurnAnalyzer(CustomSmartTurnAnalyzer):
+    """Answers turn-detect with the responses recorded for the same pause.
+
+    Responses are matched on the audio clock rather than in order, so a replay
+    that asks at other pauses than the captured call (a different stop
+    threshold, skipped requests) still gets the answer for the right audio.
+    Pauses the captured call never asked about are answered as incomplete.
+    """
+
+    def __init__(self, *, responses: List[Dict[str, Any]], speed: float = 1.0, **kwargs):
+        super().__init__(aiohttp_session=None, base_url=REPLAY_URL, **kwargs)
+        self._responses = deque(responses)
+        self._speed = speed
+        self.audio_secs = 0.0
+        self.last_speech_at: Optional[float] = None
+        self.requests = 0
+
+    def append_audio(self, buffer: bytes, is_speech: bool):
+        self.audio_secs += len(buffer) / 2 / self.sample_rate
+        if is_speech:
+            self.last_speech_at = time.monotonic()
+        return super().append_audio(buffer, is_speech)
+
+    async def _request_prediction(self, audio_array) -> Dict[str, Any]:
+        self.requests += 1
+        response = self._take_response()
+        if not response:
+            return {
+                "prediction": 0,
+                "probability": 0.0,
+                "metrics": {"inference_time": 0.0, "total_time": 0.0},
+            }
+        await asyncio.sleep(response["e2e_processing_time_ms"] / 1000 / self._speed)
+        return {
+            "prediction": 1 if response["is_complete"] else 0,
+            "probability": response["probability"],
+            "metrics": {
+                "inference_time": response["inference_time_ms"] / 1000,
+                "total_time": response["server_total_time_ms"] / 1000,
+            },
+        }
+
+    def _take_response(self) -> Optional[Dict[str, Any]]:
+        # Responses to pauses this replay didn't ask about are dropped
+        while self._responses and _request_secs(self._responses[0]) < self.audio_secs - RESPONSE_MATCH_SECS:
+            self._responses.popleft()
+        if self._responses and _request_secs(self._responses[0]) <= self.audio_secs + RESPONSE_MATCH_SECS:
+            return self._responses.popleft()
+        return None
+
+
+def _request_secs(response: Dict[str, Any]) -> float:
+    # The response was recorded when it arrived, the request went out earlier
+    return response["t"] - response["e2e_processing_time_ms"] / 1000
+
+
+#
+# Transport
+#
+
+
+class ReplayInputTransport(BaseInputTransport):
+    def __init__(self, transport: "ReplayTransport", params: TransportParams, **kwargs):
+        super().__init__(params, **kwargs)
+        self._transport = transport
+        self._feed_task = None
+        self.chunks_fed = 0
+        # Chunks still queued when the audio task was stopped
+        self.chunks_dropped = 0
+
+    @property
+    def chunks_processed(self) -> int:
+        return self.chunks_fed - self.chunks_dropped
+
+    async def start(self, frame: StartFrame):
+        await super().start(frame)
+        await self.set_transport_ready(frame)
+        if not self._feed_task:
+            self._feed_task = self.create_task(self._feed())
+
+    async def stop(self, frame: EndFrame):
+        await self._cancel_feed_task()
+        await super().stop(frame)
+
+    async def cancel(self, frame):
+        await self._cancel_feed_task()
+        await super().cancel(frame)
+
+    async def cleanup(self):
+        await super().cleanup()
+        # The EndFrame reaches the end of the pipeline before stop() is done
+        # here, so the pipeline may finish and cancel stop() halfway, leaving
+        # the audio task of BaseInputTransport running.
+        await self._cancel_feed_task()
+        await self._cancel_audio_task()
+
+    async def _cancel_audio_task(self):
+        # On Python 3.11 `asyncio.wait_for` in the audio task swallows the
+        # cancellation when a frame is queued at the same moment, and the task
+        # keeps running. Replays queue frames fast enough to hit this, so keep
+        # cancelling until the task is really done.
+        if not self._audio_task:
+            return
+        self.chunks_dropped += self._audio_in_queue.qsize()
+        task = self._audio_task
+        while not task.done():
+            task.cancel()
+            await asyncio.wait([task], timeout=AUDIO_TASK_CANCEL_SECS)
+        # Already done, this only lets the task manager forget it
+        await self.cancel_task(task)
+        self._audio_task = None
+
+    async def _cancel_feed_task(self):
+        if self._feed_task:
+            await self.cancel_task(self._feed_task)
+            self._feed_task = None
+
+    async def _feed(self):
+        await self._transport._call_event_handler("on_client_connected", "replay")
+        start_time = time.monotonic()
+        for chunk in self._transport.audio:
+            delay = chunk.t / self._transport.speed - (time.monotonic() - start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.push_audio_frame(
+                InputAudioRawFrame(
+                    audio=chunk.audio,
+                    sample_rate=chunk.sample_rate,
+                    num_channels=chunk.num_channels,
+                )
+            )
+            self.chunks_fed += 1
+        await self._wait_for_audio_processed()
+        self._transport.input_finished.set()
+
+    async def _wait_for_audio_processed(self):
+        # The filter and VAD can fall behind a fast feed, the tail of the call
+        # only starts once they went through every chunk. Otherwise the last
+        # turns depend on the replay speed and the machine.
+        if not self._audio_task:
+            return
+        join = asyncio.create_task(self._audio_in_queue.join())
+        await asyncio.wait([join, self._audio_task], return_when=asyncio.FIRST_COMPLETED)
+        join.cancel()
+
+
+class ReplayOutputTransport(BaseOutputTransport):
+    def __init__(self, transport: "ReplayTransport", params: TransportParams, **kwargs):
+        super().__init__(params, **kwargs)
+        self._transport = transport
+
+    async def start(self, frame: StartFrame):
+        await super().start(frame)
+        await self.set_transport_ready(frame)
+
+    async def write_audio_frame(self, frame: OutputAudioRawFrame):
+        # Emulate playback time so bot speaking state matches a live call.
+        secs = len(frame.audio) / (frame.sample_rate * frame.num_channels * 2)
+        await asyncio.sleep(secs / self._transport.speed)
+
+
+class ReplayTransport(BaseTransport):
+    """Transport that feeds captured inbound audio and discards output audio."""
+
+    def __init__(self, audio: List[AudioChunk], params: TransportParams, speed: float = 1.0):
+        super().__init__()
+        self._params = params
+        self.audio = audio
+        self.speed = speed
+        self.input_finished = asyncio.Event()
+        self._input: Optional[ReplayInputTransport] = None
+        self._output: Optional[ReplayOutputTransport] = None
+
+        self._register_event_handler("on_client_connected")
+        self._register_event_handler("on_client_disconnected")
+        self._register_event_handler("on_client_closed")
+
+    def input(self) -> ReplayInputTransport:
+        if not self._input:
+            self._input = ReplayInputTransport(self, self._params, name=self._input_name)
+        return self._input
+
+    def output(self) -> ReplayOutputTransport:
+        if not self._output:
+            self._output = ReplayOutputTransport(self, self._params, name=self._output_name)
+        return self._output
+
+
+#
+# Measurements
+#
+
+
+class StageCPUMeter:
+    """Measures CPU time spent in the synchronous audio front-end stages.
+
+    The noise filter, VAD and turn analyzer run CPU-bound code without yielding
+    to the event loop, so thread CPU time around each call is attributable to
+    that stage alone.
+    """
+
+    def __init__(self):
+        self.cpu_secs: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def instrument(self, params: TransportParams):
+        if params.audio_in_filter:
+            params.audio_in_filter.filter = self._wrap_async(
+                "audio_filter", params.audio_in_filter.filter
+            )
+        if params.vad_analyzer:
+            params.vad_analyzer.analyze_audio = self._wrap(
+                "vad", params.vad_analyzer.analyze_audio
+            )
+        if params.turn_analyzer:
+            params.turn_analyzer.append_audio = self._wrap(
+                "turn_append_audio", params.turn_analyzer.append_audio
+            )
+
+    def _wrap(self, stage: str, fn):
+        def wrapper(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.cpu_secs[stage] += time.thread_time() - start
+                self.calls[stage] += 1
+
+        return wrapper
+
+    def _wrap_async(self, stage: str, fn):
+        async def wrapper(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.cpu_secs[stage] += time.thread_time() - start
+                self.calls[stage] += 1
+
+        return wrapper
+
+
+class StageLatencyObserver(BaseObserver):
+    """Collects per-stage latency samples (in seconds) while a call is replayed.
+
+    Also counts the turns and the false cuts, speech starting within
+    `false_cut_window_secs` of audio after a turn ended, the same definition
+    `AdaptiveTurnController` learns from.
+    """
+
+    def __init__(
+        self,
+        *,
+        transport: ReplayTransport,
+        turn_analyzer: ReplaySmartTurnAnalyzer,
+        stt,
+        llm,
+        tts,
+    ):
+        super().__init__()
+        self._input = transport.input()
+        self._output = transport.output()
+        self._turn_analyzer = turn_analyzer
+        self._labels = {stt.name: "stt", llm.name: "llm", tts.name: "tts"}
+        self._false_cut_window_secs = AdaptiveTurnParams().false_cut_window_secs
+        self._user_stopped_at: Optional[float] = None
+        self._speech_ended_at: Optional[float] = None
+        self._turn_ended_audio_secs: Optional[float] = None
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.turns = 0
+        self.false_cuts = 0
+
+    async def on_push_frame(self, data: FramePushed):
+        frame = data.frame
+        src = data.source
+
+        if isinstance(frame, MetricsFrame):
+            for metrics in frame.data:
+                if isinstance(metrics, SmartTurnMetricsData):
+                    if src is self._input:
+                        self.samples["smart_turn.e2e"].append(
+                            metrics.e2e_processing_time_ms / 1000
+                        )
+                    continue
+                label = self._labels.get(metrics.processor)
+                if not label or metrics.processor != src.name:
+                    continue
+                if isinstance(metrics, TTFBMetricsData):
+                    self.samples[f"{label}.ttfb"].append(metrics.value)
+                elif isinstance(metrics, ProcessingMetricsData):
+                    self.samples[f"{label}.processing"].append(metrics.value)
+        elif isinstance(frame, UserStoppedSpeakingFrame) and src is self._input:
+            self._user_stopped_at = time.monotonic()
+            self._speech_ended_at = self._turn_analyzer.last_speech_at
+            self._turn_ended_audio_secs = self._turn_analyzer.audio_secs
+            self.turns += 1
+        elif isinstance(frame, UserStartedSpeakingFrame) and src is self._input:
+            if (
+                self._turn_ended_audio_secs is not None
+                and self._turn_analyzer.audio_secs - self._turn_ended_audio_secs
+                <= self._false_cut_window_secs
+            ):
+                self.false_cuts += 1
+            self._turn_ended_audio_secs = None
+        elif (
+            isinstance(frame, BotStartedSpeakingFrame)
+            and src is self._output
+            and data.direction == FrameDirection.DOWNSTREAM
+        ):
+            if self._user_stopped_at is not None:
+                self.samples["turn.user_stopped_to_bot_started"].append(
+                    time.monotonic() - self._user_stopped_at
+                )
+                self._user_stopped_at = None
+            if self._speech_ended_at is not None:
+                # Includes the silence waited for before the turn ended
+                self.samples["turn.speech_end_to_bot_started"].append(
+                    time.monotonic() - self._speech_ended_at
+                )
+                self._speech_ended_at = None
+
+
+@dataclass
+class ReplayResult:
+    samples: Dict[str, List[float]]
+    # Captured audio chunks that went through the filter, VAD and turn analyzer
+    chunks_processed: int
+    turns: int
+    false_cuts: int
+    turn_detect_requests: int
+    stop_secs: float
+
+
+async def replay_capture(
+    capture: Capture,
+    speed: float,
+    tail_secs: float,
+    cpu_meter: StageCPUMeter,
+    call_id: Optional[str] = None,
+    adaptive_turn: bool = False,
+) -> ReplayResult:
+    """Replay a capture through the pipeline.
+
+    With `adaptive_turn` the turn analyzer gets an `AdaptiveTurnController`,
+    as `run_bot` does with `ADAPTIVE_TURN=1`.
+    """
+    vad_analyzer = create_vad_analyzer()
+    turn_controller = AdaptiveTurnController(vad_analyzer=vad_analyzer) if adaptive_turn else None
+    turn_analyzer = ReplaySmartTurnAnalyzer(
+        responses=capture.smart_turn,
+        speed=speed,
+        turn_controller=turn_controller,
+        call_id=call_id,
+    )
+    params = create_transport_params(vad_analyzer, turn_analyzer)
+    cpu_meter.instrument(params)
+    transport = ReplayTransport(capture.audio, params, speed=speed)
+
+    stt = ReplaySTTService(responses=capture.stt, speed=speed, call_id=call_id)
+    llm = ReplayLLMService(responses=capture.llm, speed=speed, call_id=call_id)
+    tts = ReplayTTSService(responses=capture.tts, speed=speed, call_id=call_id)
+
+    latency = StageLatencyObserver(
+        transport=transport, turn_analyzer=turn_analyzer, stt=stt, llm=llm, tts=tts
+    )
+    task = create_pipeline_task(
+        transport,
+        stt,
+        llm,
+        tts,
+        observers=[latency],
+        call_memory=register_call(call_id) if call_id else None,
+    )
+
+    runner = PipelineRunner(handle_sigint=False)
+    run = asyncio.create_task(runner.run(task))
+    finished = asyncio.create_task(transport.input_finished.wait())
+    await asyncio.wait([run, finished], return_when=asyncio.FIRST_COMPLETED)
+    if not run.done():
+        # Let the last turn play out before ending the call.
+        await asyncio.sleep(tail_secs / speed)
+        await task.queue_frame(EndFrame())
+    await run
+    finished.cancel()
+    await close_call_clients(stt, llm, tts)
+
+    processed = transport.input().chunks_processed
+    if processed < len(capture.audio):
+        logger.warning(
+            f"Only {processed} of {len(capture.audio)} audio chunks of {capture.path} were processed"
+        )
+    return ReplayResult(
+        samples=latency.samples,
+        chunks_processed=processed,
+        turns=latency.turns,
+        false_cuts=latency.false_cuts,
+        turn_detect_requests=turn_analyzer.requests,
+        stop_secs=vad_analyzer.params.stop_secs,
+    )
+
+
+def _summarize(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+async def run_replay(paths: List[str], speed: float, tail_secs: float) -> Dict[str, Any]:
+    cpu_meter = StageCPUMeter()
+    samples: Dict[str, List[float]] = defaultdict(list)
+    audio_secs = 0.0
+    captured_chunks = 0
+    processed_chunks = 0
+
+    leaked_calls = 0
+
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    for i, path in enumerate(paths):
+        capture = load_capture(Path(path))
+        logger.info(f"Replaying {capture.path} ({capture.audio_secs:.1f}s of audio)")
+        audio_secs += capture.audio_secs
+        call_id = f"replay-{i}"
+        result = await replay_capture(capture, speed, tail_secs, cpu_meter, call_id)
+        captured_chunks += len(capture.audio)
+        processed_chunks += result.chunks_processed
+        for stage, values in result.samples.items():
+            samples[stage].extend(values)
+        if check_call_teardown(call_id):
+            leaked_calls += 1
+    wall_secs = time.monotonic() - wall_start
+    cpu_secs = time.process_time() - cpu_start
+
+    return {
+        "commit": _git_commit(),
+        "captures": paths,
+        "speed": speed,
+        "audio_secs": audio_secs,
+        "wall_secs": wall_secs,
+        "cpu_secs": cpu_secs,
+        "cpu_per_audio_sec": cpu_secs / audio_secs if audio_secs else 0.0,
+        "audio_chunks": {"captured": captured_chunks, "processed": processed_chunks},
+        "leaked_calls": leaked_calls,
+        "scheduler": scheduler_report()["priorities"],
+        "stages": {stage: _summarize(values) for stage, values in sorted(samples.items())},
+        "stage_cpu": {
+            stage: {
+                "cpu_ms": cpu_meter.cpu_secs[stage] * 1000,
+                "calls": cpu_meter.calls[stage],
+                "us_per_call": cpu_meter.cpu_secs[stage] * 1e6 / max(cpu_meter.calls[stage], 1),
+            }
+            for stage in sorted(cpu_meter.cpu_secs)
+        },
+    }
+
+
+async def run_turn_compare(paths: List[str], speed: float, tail_secs: float) -> Dict[str, Any]:
+    """Replay the same captures with the adaptive turn controller and without.
+
+    Both modes get the same recorded turn-detect responses, so the false cuts
+    and turn latencies measured are down to the stop threshold and the
+    skipped requests alone.
+    """
+    modes = {"fixed": False, "adaptive": True}
+    results: Dict[str, List[ReplayResult]] = defaultdict(list)
+    for path in paths:
+        capture = load_capture(Path(path))
+        for mode, adaptive_turn in modes.items():
+            logger.info(f"Replaying {capture.path} with {mode} turn timing")
+            results[mode].append(
+                await replay_capture(
+                    capture, speed, tail_secs, StageCPUMeter(), adaptive_turn=adaptive_turn
+                )
+            )
+
+    report: Dict[str, Any] = {"commit": _git_commit(), "captures": paths, "speed": speed}
+    for mode in modes:
+        turns = sum(result.turns for result in results[mode])
+        false_cuts = sum(result.false_cuts for result in results[mode])
+        latencies = [
+            value
+            for result in results[mode]
+            for value in result.samples["turn.speech_end_to_bot_started"]
+        ]
+        report[mode] = {
+            "turns": turns,
+            "false_cuts": false_cuts,
+            "false_cut_rate": false_cuts / turns if turns else 0.0,
+            "turn_latency": _summarize(latencies) if latencies else None,
+            "turn_detect_requests": sum(result.turn_detect_requests for result in results[mode]),
+            "stop_secs": [result.stop_secs for result in results[mode]],
+        }
+    return report
+
+
+async def run_soak(
+    path: str, calls: int, concurrency: int, speed: float, tail_secs: float, warmup: int
+) -> Dict[str, Any]:
+    """Replay one capture many times and track how RSS evolves.
+
+    RSS is sampled after every `concurrency` calls, once they have all been
+    torn down. After the warmup calls (allocator pools, model sessions and
+    caches filling up) the RSS should stay flat, growth means memory is
+    retained per call.
+    """
+    capture = load_capture(Path(path))
+    cpu_meter = StageCPUMeter()
+    leaked_calls = 0
+    samples: List[Dict[str, Any]] = []
+    baseline_rss = None
+
+    async def soak_call(n: int):
+        nonlocal leaked_calls
+        call_id = f"soak-{n}"
+        await replay_capture(capture, speed, tail_secs, cpu_meter, call_id)
+        if check_call_teardown(call_id):
+            leaked_calls += 1
+
+    started = 0
+    start_time = time.monotonic()
+    while started < calls:
+        batch = min(concurrency, calls - started)
+        await asyncio.gather(*(soak_call(started + i) for i in range(batch)))
+        started += batch
+
+        rss = current_rss_bytes()
+        samples.append({"calls": started, "rss_bytes": rss})
+        logger.info(f"Soak: {started}/{calls} calls, RSS {rss / 2**20:.1f} MiB")
+        if baseline_rss is None and started >= warmup:
+            baseline_rss = rss
+
+    final_rss = samples[-1]["rss_bytes"]
+    baseline_rss = baseline_rss or samples[0]["rss_bytes"]
+    measured_calls = max(calls - warmup, 1)
+    return {
+        "commit": _git_commit(),
+        "capture": path,
+        "calls": calls,
+        "concurrency": concurrency,
+        "speed": speed,
+        "wall_secs": time.monotonic() - start_time,
+        "leaked_calls": leaked_calls,
+        "baseline_rss_bytes": baseline_rss,
+        "final_rss_bytes": final_rss,
+        "max_rss_bytes": max(sample["rss_bytes"] for sample in samples),
+        "growth_bytes_per_call": (final_rss - baseline_rss) / measured_calls,
+        "samples": samples,
+    }
+
+
+#
+# Real WebRTC call
+#
+
+
+class CaptureAudioTrack(MediaStreamTrack):
+    """Client microphone track playing the captured inbound audio in real time."""
+
+    kind = "audio"
+
+    FRAME_SECS = 0.02
+
+    def __init__(self, capture: Capture):
+        super().__init__()
+        self._sample_rate = capture.audio[0].sample_rate if capture.audio else 16000
+        self._audio = b"".join(chunk.audio for chunk in capture.audio)
+        self._samples_per_frame = int(self._sample_rate * self.FRAME_SECS)
+        self._pts = 0
+        self._start = None
+
+    async def recv(self) -> av.AudioFrame:
+        if self._start is None:
+            self._start = time.monotonic()
+        wait = self._start + self._pts / self._sample_rate - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        # Silence once the capture is over
+        size = self._samples_per_frame * 2
+        data = self._audio[self._pts * 2 : self._pts * 2 + size]
+        data += bytes(size - len(data))
+
+        frame = av.AudioFrame(format="s16", layout="mono", samples=self._samples_per_frame)
+        frame.planes[0].update(data)
+        frame.sample_rate = self._sample_rate
+        frame.pts = self._pts
+        frame.time_base = fractions.Fraction(1, self._sample_rate)
+        self._pts += self._samples_per_frame
+        return frame
+
+
+async def run_webrtc_call(webrtc_connection, capture: Capture, tail_secs: float):
+    """Bot for a real WebRTC connection, with the mock backends of the replay."""
+    call_id = webrtc_connection.pc_id
+    turn_analyzer = ReplaySmartTurnAnalyzer(responses=capture.smart_turn, call_id=call_id)
+    transport = SmallWebRTCTransport(
+        webrtc_connection=webrtc_connection,
+        params=create_transport_params(create_vad_analyzer(), turn_analyzer),
+    )
+    stt = ReplaySTTService(responses=capture.stt, call_id=call_id)
+    llm = ReplayLLMService(responses=capture.llm, call_id=call_id)
+    tts = ReplayTTSService(responses=capture.tts, call_id=call_id)
+
+    task = create_pipeline_task(
+        transport, stt, llm, tts, call_memory=register_call(call_id)
+    )
+
+    async def end_call():
+        # The bot hangs up once the caller's audio has played out
+        await asyncio.sleep(capture.audio_secs + tail_secs)
+        await task.queue_frame(EndFrame())
+
+    runner = PipelineRunner(handle_sigint=False)
+    end = asyncio.create_task(end_call())
+    try:
+        await runner.run(task)
+    finally:
+        end.cancel()
+        await close_call_clients(stt, llm, tts)
+
+
+async def run_webrtc_check(path: str, tail_secs: float) -> Dict[str, Any]:
+    """Run one call over a real SmallWebRTC connection and check its teardown.
+
+    The call goes through the server's call handling with a local aiortc peer
+    as the caller, so references held by the WebRTC connection and by the
+    server are covered, unlike in replays with the mock transport.
+    """
+    # Imported here, server sets up the FastAPI app and the records directory
+    import server
+
+    capture = load_capture(Path(path))
+    leaked_before = memory_report()["leaked_calls_total"]
+
+    client = RTCPeerConnection()
+    client.addTrack(CaptureAudioTrack(capture))
+    client.addTransceiver("video", direction="recvonly")
+    client.createDataChannel("chat")
+    await client.setLocalDescription(await client.createOffer())
+
+    connection = SmallWebRTCConnection([])
+    await connection.initialize(sdp=client.localDescription.sdp, type=client.localDescription.type)
+    answer = connection.get_answer()
+    server.pcs_map[answer["pc_id"]] = connection
+    await client.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+
+    call = server.start_call(
+        connection, bot=lambda conn: run_webrtc_call(conn, capture, tail_secs)
+    )
+    del connection
+
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.shield(call), timeout=capture.audio_secs + tail_secs + 30)
+    finally:
+        await client.close()
+    # Let the teardown check scheduled by the server run
+    await asyncio.sleep(0)
+
+    report = memory_report()
+    return {
+        "capture": path,
+        "pc_id": answer["pc_id"],
+        "call_secs": time.monotonic() - start,
+        "leaked_calls": report["leaked_calls_total"] - leaked_before,
+        "leaked": report["leaked_calls"].get(answer["pc_id"]),
+    }
+
+
+#
+# Smart-turn features
+#
+
+# Turn lengths checked, in samples at 16 kHz: shorter than half a window, a few
+# frames, a typical turn, just under, at and past 8 seconds, and a truncation
+# point that is not on a hop boundary.
+FEATURE_CHECK_SAMPLES = [120, 1000, 48000, 127_900, 128_000, 128_160, 200_000, 200_037]
+
+# Largest difference from the reference, in normalized log-mel units
+FEATURE_CHECK_TOLERANCE = 1e-3
+
+
+def reference_features(audio) -> Any:
+    """Smart-turn model input computed from scratch, like the reference extractor.
+
+    That is Whisper's `WhisperFeatureExtractor(chunk_length=8)` with
+    padding="max_length", max_length=128000 and do_normalize=True, on the last
+    8 seconds of the turn: normalize, zero pad to 8 seconds, centered STFT with
+    reflect padding, log-mel, drop the last frame.
+    """
+    import numpy as np
+    from smart_turn_model import HOP_LENGTH, MAX_SAMPLES, MEL_FILTERS, N_FFT
+
+    audio = audio[-MAX_SAMPLES:].astype(np.float64)
+    audio = (audio - audio.mean()) / np.sqrt(audio.var() + 1e-7)
+    audio = np.pad(audio, (0, MAX_SAMPLES - len(audio)))
+    audio = np.pad(audio, N_FFT // 2, mode="reflect")
+    frames = np.lib.stride_tricks.sliding_window_view(audio, N_FFT)[::HOP_LENGTH]
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N_FFT) / N_FFT)
+    power = np.abs(np.fft.rfft(frames * window, axis=-1)) ** 2
+    log_mel = np.log10(np.maximum(power @ MEL_FILTERS.T, 1e-10))[:-1]
+    log_mel = np.maximum(log_mel, log_mel.max() - 8.0)
+    return ((log_mel + 4.0) / 4.0).T
+
+
+def run_features_check(path: str) -> Dict[str, Any]:
+    """Compare the incremental smart-turn features with `reference_features`.
+
+    Turns of `FEATURE_CHECK_SAMPLES` lengths are cut from the capture's inbound
+    audio, repeated if the capture is shorter, and appended in the recorded
+    chunk sizes as well as in odd sized chunks.
+    """
+    import numpy as np
+    from smart_turn_model import SAMPLE_RATE, IncrementalLogMel, batch_features
+
+    capture = load_capture(Path(path))
+    if not capture.audio or capture.audio[0].sample_rate != SAMPLE_RATE:
+        raise ValueError(f"Capture audio must be {SAMPLE_RATE} Hz")
+    audio = np.frombuffer(b"".join(chunk.audio for chunk in capture.audio), dtype=np.int16)
+    audio = audio.astype(np.float32) / 32768.0
+    recorded_chunk = len(capture.audio[0].audio) // 2
+
+    results = []
+    for num_samples in FEATURE_CHECK_SAMPLES:
+        turn = np.resize(audio, num_samples)
+        expected = reference_features(turn)
+        for chunk_size in (recorded_chunk, 333):
+            features = IncrementalLogMel()
+            for i in range(0, num_samples, chunk_size):
+                features.append(turn[i : i + chunk_size])
+            actual = batch_features([features.snapshot()])[0]
+            diff = np.abs(actual - expected)
+            results.append(
+                {
+                    "samples": num_samples,
+                    "chunk_samples": chunk_size,
+                    "max_diff": float(diff.max()),
+                    "worst_frame": int(diff.max(axis=0).argmax()),
+                }
+            )
+    return {
+        "capture": path,
+        "max_diff": max(result["max_diff"] for result in results),
+        "turns": results,
+    }
+
+
+def compare_reports(
+    baseline: Dict[str, Any], candidate: Dict[str, Any], threshold: float, min_ms: float
+) -> List[str]:
+    """Return a description of every metric that regressed beyond the threshold."""
+    if baseline.get("speed") != candidate.get("speed"):
+        logger.warning("Reports were produced with different replay speeds")
+    for name, report in (("Baseline", baseline), ("Candidate", candidate)):
+        chunks = report.get("audio_chunks")
+        if chunks and chunks["processed"] < chunks["captured"]:
+            logger.warning(
+                f"{name} report only processed {chunks['processed']} of "
+                f"{chunks['captured']} audio chunks"
+            )
+
+    rows = []
+    for stage, base in baseline["stages"].items():
+        cand = candidate["stages"].get(stage)
+        if cand:
+            for key in ("p50_ms", "p95_ms"):
+                rows.append((f"{stage}.{key}", base[key], cand[key], min_ms))
+    for stage, base in baseline["stage_cpu"].items():
+        cand = candidate["stage_cpu"].get(stage)
+        if cand:
+            rows.append((f"cpu.{stage}.us_per_call", base["us_per_call"], cand["us_per_call"], 0))
+    for priority, base in baseline.get("scheduler", {}).items():
+        cand = candidate.get("scheduler", {}).get(priority)
+        if cand:
+            rows.append(
+                (f"queue.{priority}.p95_ms", base["queue_delay_p95_ms"], cand["queue_delay_p95_ms"], min_ms)
+            )
+    rows.append(("cpu.total_per_audio_sec", baseline["cpu_per_audio_sec"], candidate["cpu_per_audio_sec"], 0))
+
+    regressions = []
+    print(f"{'metric':<50} {'baseline':>12} {'candidate':>12} {'change':>8}")
+    for name, base, cand, min_delta in rows:
+        change = (cand - base) / base if base else 0.0
+        regressed = change > threshold and (cand - base) > min_delta
+        marker = "  REGRESSION" if regressed else ""
+        print(f"{name:<50} {base:>12.3f} {cand:>12.3f} {change:>+7.1%}{marker}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured calls offline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Replay captures and report latency and CPU")
+    run_parser.add_argument("captures", nargs="+", help="Capture directories")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor")
+    run_parser.add_argument(
+        "--tail-secs", type=float, default=5.0, help="Seconds to wait after the last audio chunk"
+    )
+    run_parser.add_argument("--output", help="Write the JSON report to this file")
+
+    soak_parser = subparsers.add_parser(
+        "soak", help="Replay a capture many times and check memory stays flat"
+    )
+    soak_parser.add_argument("capture", help="Capture directory")
+    soak_parser.add_argument("--calls", type=int, default=1000, help="Number of calls")
+    soak_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent calls")
+    soak_parser.add_argument("--speed", type=float, default=10.0, help="Replay speed factor")
+    soak_parser.add_argument(
+        "--tail-secs", type=float, default=5.0, help="Seconds to wait after the last audio chunk"
+    )
+    soak_parser.add_argument(
+        "--warmup", type=int, default=50, help="Calls before the RSS baseline is taken"
+    )
+    soak_parser.add_argument(
+        "--max-growth-per-call",
+        type=int,
+        default=1024,
+        help="RSS growth per call in bytes counted as a leak",
+    )
+    soak_parser.add_argument("--output", help="Write the JSON report to this file")
+
+    webrtc_parser = subparsers.add_parser(
+        "webrtc-check", help="Run a call over a real WebRTC connection and check for leaks"
+    )
+    webrtc_parser.add_argument("capture", help="Capture directory")
+    webrtc_parser.add_argument(
+        "--tail-secs", type=float, default=5.0, help="Seconds to wait after the last audio chunk"
+    )
+
+    features_parser = subparsers.add_parser(
+        "features-check", help="Check the smart-turn features against the reference extractor"
+    )
+    features_parser.add_argument("capture", help="Capture directory")
+
+    turn_parser = subparsers.add_parser(
+        "turn-compare", help="Measure false cuts and turn latency with adaptive and fixed turn timing"
+    )
+    turn_parser.add_argument("captures", nargs="+", help="Capture directories")
+    turn_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor")
+    turn_parser.add_argument(
+        "--tail-secs", type=float, default=5.0, help="Seconds to wait after the last audio chunk"
+    )
+    turn_parser.add_argument("--output", help="Write the JSON report to this file")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two replay reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Relative increase counted as regression"
+    )
+    compare_parser.add_argument(
+        "--min-ms", type=float, default=5.0, help="Ignore latency increases smaller than this"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.speed <= 0:
+            parser.error("--speed must be positive")
+        report = asyncio.run(run_replay(args.captures, args.speed, args.tail_secs))
+        output = json.dumps(report, indent=2)
+        if args.output:
+            Path(args.output).write_text(output)
+        print(output)
+    elif args.command == "soak":
+        if args.speed <= 0:
+            parser.error("--speed must be positive")
+        report = asyncio.run(
+            run_soak(
+                args.capture,
+                args.calls,
+                args.concurrency,
+                args.speed,
+                args.tail_secs,
+                args.warmup,
+            )
+        )
+        output = json.dumps(report, indent=2)
+        if args.output:
+            Path(args.output).write_text(output)
+        print(output)
+        if report["leaked_calls"] or report["growth_bytes_per_call"] > args.max_growth_per_call:
+            print("Memory is retained across calls")
+            sys.exit(1)
+    elif args.command == "webrtc-check":
+        report = asyncio.run(run_webrtc_check(args.capture, args.tail_secs))
+        print(json.dumps(report, indent=2))
+        if report["leaked_calls"]:
+            print("Call objects are still alive after teardown")
+            sys.exit(1)
+    elif args.command == "features-check":
+        report = run_features_check(args.capture)
+        print(json.dumps(report, indent=2))
+        if report["max_diff"] > FEATURE_CHECK_TOLERANCE:
+            print("Smart-turn features differ from the reference extractor")
+            sys.exit(1)
+    elif args.command == "turn-compare":
+        if args.speed <= 0:
+            parser.error("--speed must be positive")
+        report = asyncio.run(run_turn_compare(args.captures, args.speed, args.tail_secs))
+        output = json.dumps(report, indent=2)
+        if args.output:
+            Path(args.output).write_text(output)
+        print(output)
+    elif args.command == "compare":
+        baseline = json.loads(Path(args.baseline).read_text())
+        candidate = json.loads(Path(args.candidate).read_text())
+        regressions = compare_reports(baseline, candidate, args.threshold, args.min_ms)
+        if regressions:
+            print(f"{len(regressions)} regression(s) found")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
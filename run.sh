@@ -72,8 +72,22 @@ stop_servers() {
   # Stop WebRTC server
   if [ -f webrtc.pid ]; then
     WEBRTC_PID=$(cat webrtc.pid)
-    echo "Stopping WebRTC server (PID: $WEBRTC_PID)..."
+    echo "Draining WebRTC server (PID: $WEBRTC_PID)..."
+    # SIGTERM makes the server stop admitting calls and wait for active ones
+    # (up to DRAIN_TIMEOUT_SECS) before exiting, so wait for it here.
     kill "$WEBRTC_PID" # Use double quotes for robustness
+    # Give up after the drain deadline plus a margin for flushing and exiting
+    source .env 2>/dev/null
+    DRAIN_SECS=${DRAIN_TIMEOUT_SECS:-300}
+    WAIT_SECS=$(( ${DRAIN_SECS%.*} + 30 ))
+    while kill -0 "$WEBRTC_PID" 2>/dev/null && [ "$WAIT_SECS" -gt 0 ]; do
+      sleep 1
+      WAIT_SECS=$((WAIT_SECS - 1))
+    done
+    if kill -0 "$WEBRTC_PID" 2>/dev/null; then
+      echo "WebRTC server did not exit after draining, killing it"
+      kill -9 "$WEBRTC_PID"
+    fi
     rm webrtc.pid
   else
     echo "No WebRTC server PID file found."
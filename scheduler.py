@@ -0,0 +1,220 @@
+"""Priority scheduler for backend requests, shared by every call in the process.
+
+Each backend (STT server, LLM server, TTS server) gets a `BackendScheduler`
+with a concurrency limit. Requests wait for a slot in priority order:
+
+    turn-detect > first TTS clause > STT > LLM > background TTS prefetch
+
+Within a priority class the calls take turns, so one call with many queued
+requests can't hold back the others. A few slots of a backend can be reserved
+for the latency critical classes (turn-detect, first TTS clause), so long
+running low priority requests can never occupy all of them.
+
+A request that waited longer than its deadline is shed with `RequestShed`,
+its result would arrive too late to be useful.
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+
+class Priority(IntEnum):
+    TURN_DETECT = 0
+    TTS_FIRST_CLAUSE = 1
+    STT = 2
+    LLM = 3
+    TTS_PREFETCH = 4
+
+
+# Classes that may use the reserved slots of a backend
+LATENCY_CRITICAL = (Priority.TURN_DETECT, Priority.TTS_FIRST_CLAUSE)
+
+# Longest time a request waits for a slot before it is shed
+DEADLINE_SECS = {
+    Priority.TURN_DETECT: 1.0,
+    Priority.TTS_FIRST_CLAUSE: 3.0,
+    Priority.STT: 5.0,
+    Priority.LLM: 10.0,
+    Priority.TTS_PREFETCH: 15.0,
+}
+
+# Number of queueing delays kept per priority class for the report
+DELAY_HISTORY_SIZE = 1000
+
+
+class RequestShed(Exception):
+    """The request waited past its deadline and was not sent to the backend."""
+
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    priority: Priority
+    enqueued_at: float
+
+
+class _PriorityStats:
+    def __init__(self):
+        self.requests = 0
+        self.shed = 0
+        self.delays: deque = deque(maxlen=DELAY_HISTORY_SIZE)
+
+    def report(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "shed": self.shed, **_summarize_delays(self.delays)}
+
+
+def _summarize_delays(delays) -> Dict[str, Any]:
+    ordered = sorted(delays)
+    if not ordered:
+        return {"queue_delay_p50_ms": 0.0, "queue_delay_p95_ms": 0.0, "queue_delay_max_ms": 0.0}
+    return {
+        "queue_delay_p50_ms": ordered[len(ordered) // 2] * 1000,
+        "queue_delay_p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "queue_delay_max_ms": ordered[-1] * 1000,
+    }
+
+
+class BackendScheduler:
+    """Limits the concurrent requests to one backend and orders the waiting ones."""
+
+    def __init__(self, name: str, max_concurrency: int, reserved_slots: int = 0):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.reserved_slots = min(reserved_slots, self.max_concurrency - 1)
+        self._active = 0
+        # Per priority, the waiting requests of each call in round robin order
+        self._queues: Dict[Priority, "OrderedDict[str, deque]"] = {
+            priority: OrderedDict() for priority in Priority
+        }
+        self._stats = {priority: _PriorityStats() for priority in Priority}
+
+    @asynccontextmanager
+    async def slot(
+        self, priority: Priority, call_id: str, deadline_secs: Optional[float] = None
+    ):
+        """Hold a backend slot for the duration of the block.
+
+        Raises `RequestShed` if no slot was given within `deadline_secs`.
+        """
+        await self._acquire(priority, call_id, deadline_secs)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def queued(self) -> int:
+        return sum(
+            1
+            for calls in self._queues.values()
+            for waiters in calls.values()
+            for waiter in waiters
+            if not waiter.future.done()
+        )
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "reserved_slots": self.reserved_slots,
+            "active": self._active,
+            "queued": self.queued(),
+            "priorities": {
+                priority.name.lower(): self._stats[priority].report() for priority in Priority
+            },
+        }
+
+    async def _acquire(self, priority: Priority, call_id: str, deadline_secs: Optional[float]):
+        stats = self._stats[priority]
+        stats.requests += 1
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), priority, time.monotonic())
+        self._queues[priority].setdefault(call_id, deque()).append(waiter)
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=deadline_secs)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was given right as the deadline passed
+                return
+            stats.shed += 1
+            logger.warning(
+                f"Shedding {priority.name} request of call {call_id} to {self.name}, "
+                f"no slot after {deadline_secs}s"
+            )
+            raise RequestShed(f"No {self.name} slot within {deadline_secs}s")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def _can_start(self, priority: Priority) -> bool:
+        limit = self.max_concurrency
+        if priority not in LATENCY_CRITICAL:
+            limit -= self.reserved_slots
+        return self._active < limit
+
+    def _dispatch(self):
+        for priority in Priority:
+            calls = self._queues[priority]
+            while calls:
+                call_id, waiters = next(iter(calls.items()))
+                waiter = waiters[0]
+                if not waiter.future.done():
+                    if not self._can_start(priority):
+                        # Lower classes can't start either, they get fewer slots
+                        return
+                    self._active += 1
+                    self._stats[priority].delays.append(time.monotonic() - waiter.enqueued_at)
+                    waiter.future.set_result(None)
+
+                # Shed and cancelled requests are dropped here as well
+                waiters.popleft()
+                if waiters:
+                    # Next request of this class goes to the next call
+                    calls.move_to_end(call_id)
+                else:
+                    del calls[call_id]
+
+
+BACKENDS = {
+    "stt": BackendScheduler(
+        "stt", int(os.getenv("STT_MAX_CONCURRENCY", "4")), reserved_slots=1
+    ),
+    "llm": BackendScheduler("llm", int(os.getenv("LLM_MAX_CONCURRENCY", "4"))),
+    "tts": BackendScheduler(
+        "tts", int(os.getenv("TTS_MAX_CONCURRENCY", "4")), reserved_slots=1
+    ),
+}
+
+
+def get_backend(name: str) -> BackendScheduler:
+    return BACKENDS[name]
+
+
+def scheduler_report() -> Dict[str, Any]:
+    """Queueing delay and shed requests per backend and per priority class."""
+    priorities = {}
+    for priority in Priority:
+        stats = [backend._stats[priority] for backend in BACKENDS.values()]
+        delays = [delay for s in stats for delay in s.delays]
+        priorities[priority.name.lower()] = {
+            "requests": sum(s.requests for s in stats),
+            "shed": sum(s.shed for s in stats),
+            **_summarize_delays(delays),
+        }
+    return {
+        "priorities": priorities,
+        "backends": {name: backend.report() for name, backend in BACKENDS.items()},
+    }
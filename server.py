@@ -1,22 +1,30 @@
 import asyncio
+import importlib
 import sys
 import os
 import json
+import socket
+import time
 from datetime import datetime
 from pathlib import Path
 from contextlib import asynccontextmanager
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional
 import platform
+import secrets
 import uvicorn
-from bot import run_bot
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Response
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel
 from loguru import logger
 from pipecat_ai_small_webrtc_prebuilt.frontend import SmallWebRTCPrebuiltUI
-from pipecat.transports.network.webrtc_connection import IceServer, SmallWebRTCConnection
+
+from call_memory import close_call, memory_report
+from scheduler import scheduler_report
+
+if TYPE_CHECKING:
+    from pipecat.transports.network.webrtc_connection import SmallWebRTCConnection
 
 # Load environment variables
 load_dotenv(override=True)
@@ -26,7 +34,19 @@ RECORDS_DIR = Path("records")
 RECORDS_DIR.mkdir(exist_ok=True)
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global startup_task
+    startup_task = asyncio.create_task(load_bot())
+    yield  # Run app
+    # SIGTERM/SIGINT already drained the calls (see DrainingServer), this
+    # covers any other way uvicorn shuts down. A forced exit skips it.
+    if http_server and http_server.force_exit:
+        return
+    await start_drain(DRAIN_TIMEOUT_SECS)
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS middleware
 app.add_middleware(
@@ -38,18 +58,270 @@ app.add_middleware(
 )
 
 # Store connections by pc_id
-pcs_map: Dict[str, SmallWebRTCConnection] = {}
+pcs_map: Dict[str, "SmallWebRTCConnection"] = {}
 
+# Bot tasks of calls in progress by pc_id
+active_calls: Dict[str, asyncio.Task] = {}
 
-ice_servers = [
-    IceServer(urls=os.getenv("STUN_SERVER")),
-    IceServer(
-        urls=os.getenv("TURN_SERVER"),
-        username=os.getenv("TURN_USERNAME"),
-        credential=os.getenv("TURN_CREDENTIAL")
-    )
+# How long a drain lets active calls finish before closing them
+DRAIN_TIMEOUT_SECS = float(os.getenv("DRAIN_TIMEOUT_SECS", "300"))
+# How long closed calls get to flush their transcript and capture files
+FLUSH_TIMEOUT_SECS = 10
+
+drain_state = {
+    "draining": False,
+    "phase": "serving",
+    "started_at": None,
+    "deadline": None,
+    "active_calls": 0,
+    "closed_calls": 0,
+}
+drain_task: Optional[asyncio.Task] = None
+# Set by DrainingServer, so a drain can close the listening socket
+http_server: Optional[uvicorn.Server] = None
+
+# Token for the admin endpoints (drain, debug), sent as "Authorization: Bearer <token>"
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Headers added by the cloudflared tunnel and other proxies, whose requests
+# also arrive from loopback
+PROXY_HEADERS = ("cf-connecting-ip", "x-forwarded-for", "forwarded")
+
+# Heavy modules are imported in the background after the server binds, in this
+# order, so health checks are answered right away. `bot` pulls in the rest of
+# the pipecat stack and patches the OpenAI LLM service.
+HEAVY_MODULES = [
+    "openai",
+    "pipecat.transports.network.webrtc_connection",
+    "pipecat.audio.vad.silero",
+    "pipecat.audio.filters.noisereduce_filter",
+    "pipecat.processors.frameworks.rtvi",
+    "pipecat.processors.transcript_processor",
+    "bot",
 ]
 
+startup_state = {
+    "ready": False,
+    "error": None,
+    "import_times_ms": {},
+    "model_load_times_ms": {},
+    "model_errors": {},
+}
+startup_task: Optional[asyncio.Task] = None
+
+# Set once the heavy modules are loaded
+run_bot = None
+SmallWebRTCConnection = None
+ice_servers = []
+
+
+def load_heavy_modules():
+    """Import heavy modules and warm up models, recording how long each takes.
+
+    Import times are incremental: a module's time excludes dependencies already
+    imported by an earlier entry of `HEAVY_MODULES`.
+    """
+    for name in HEAVY_MODULES:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        startup_state["import_times_ms"][name] = round(elapsed_ms, 1)
+        logger.debug(f"Imported {name} in {elapsed_ms:.1f}ms")
+
+    # Loading the Silero model once warms the ONNX runtime and the model file
+    # for the first call.
+    from pipecat.audio.vad.silero import SileroVADAnalyzer
+
+    start = time.perf_counter()
+    SileroVADAnalyzer()
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    startup_state["model_load_times_ms"]["silero_vad"] = round(elapsed_ms, 1)
+    logger.debug(f"Loaded Silero VAD model in {elapsed_ms:.1f}ms")
+
+    # The smart turn ONNX session is shared by all calls, load it before the
+    # first one. Calls only use it if it is loaded here, without it they fall
+    # back to the turn-detect endpoint.
+    model_path = os.getenv("SMART_TURN_MODEL_PATH")
+    if model_path:
+        start = time.perf_counter()
+        try:
+            from smart_turn_model import get_shared_model
+
+            get_shared_model(model_path)
+        except Exception as e:
+            logger.error(f"Error loading smart turn model, calls use turn-detect endpoint: {e}")
+            startup_state["model_errors"]["smart_turn"] = str(e)
+        else:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            startup_state["model_load_times_ms"]["smart_turn"] = round(elapsed_ms, 1)
+            logger.debug(f"Loaded smart turn model in {elapsed_ms:.1f}ms")
+
+
+async def load_bot():
+    global run_bot, SmallWebRTCConnection, ice_servers
+
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(load_heavy_modules)
+    except Exception as e:
+        logger.exception(f"Error loading bot modules: {e}")
+        startup_state["error"] = str(e)
+        return
+
+    from bot import run_bot as _run_bot
+    from pipecat.transports.network.webrtc_connection import IceServer
+    from pipecat.transports.network.webrtc_connection import (
+        SmallWebRTCConnection as _SmallWebRTCConnection,
+    )
+
+    run_bot = _run_bot
+    SmallWebRTCConnection = _SmallWebRTCConnection
+    ice_servers = [
+        IceServer(urls=os.getenv("STUN_SERVER")),
+        IceServer(
+            urls=os.getenv("TURN_SERVER"),
+            username=os.getenv("TURN_USERNAME"),
+            credential=os.getenv("TURN_CREDENTIAL")
+        )
+    ]
+
+    startup_state["ready"] = True
+    logger.info(f"Bot ready in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+async def wait_until_ready():
+    if startup_task:
+        await asyncio.shield(startup_task)
+    if not startup_state["ready"]:
+        raise HTTPException(status_code=503, detail="Bot is not ready")
+
+
+async def release_connection(webrtc_connection: "SmallWebRTCConnection"):
+    """Close a finished call's connection and drop the handlers registered on it.
+
+    The transport's handlers close over the transport and through it the
+    whole pipeline, they would keep the call alive as long as anything still
+    references the connection.
+    """
+    pcs_map.pop(webrtc_connection.pc_id, None)
+    try:
+        await webrtc_connection.disconnect()
+    except Exception as e:
+        logger.warning(f"Error closing connection {webrtc_connection.pc_id}: {e}")
+    for handlers in webrtc_connection._event_handlers.values():
+        handlers.clear()
+
+
+async def run_call(
+    webrtc_connection: "SmallWebRTCConnection",
+    bot: Optional[Callable[["SmallWebRTCConnection"], Awaitable]] = None,
+):
+    """Run the bot for a call and keep track of it until the pipeline ends."""
+    pc_id = webrtc_connection.pc_id
+    try:
+        await (bot or run_bot)(webrtc_connection)
+    finally:
+        active_calls.pop(pc_id, None)
+        await release_connection(webrtc_connection)
+
+
+def start_call(
+    webrtc_connection: "SmallWebRTCConnection",
+    bot: Optional[Callable[["SmallWebRTCConnection"], Awaitable]] = None,
+) -> asyncio.Task:
+    """Run a call in its own task.
+
+    Calls don't run as background tasks of the offer request, uvicorn would
+    wait for them without a deadline before the drain even starts.
+    """
+    pc_id = webrtc_connection.pc_id
+    task = asyncio.create_task(run_call(webrtc_connection, bot))
+    active_calls[pc_id] = task
+    # Only once run_call has returned its frame no longer references the
+    # connection, so everything the call allocated should be collectable.
+    # It is checked by GET /api/debug/memory, not here on every call.
+    task.add_done_callback(lambda _: close_call(pc_id))
+    return task
+
+
+async def drain(timeout: float):
+    """Stop admitting calls, let active ones finish, then close the rest.
+
+    Calls still running at the deadline have their connections closed
+    concurrently, which cancels their pipelines. We then wait for the bot tasks
+    to exit so transcript and capture files are flushed and closed.
+    """
+    start = time.time()
+    drain_state.update(
+        draining=True,
+        phase="waiting_for_calls",
+        started_at=datetime.fromtimestamp(start).isoformat(),
+        deadline=datetime.fromtimestamp(start + timeout).isoformat(),
+        active_calls=len(active_calls),
+    )
+    logger.info(f"Draining {len(active_calls)} active calls, deadline in {timeout:.0f}s")
+
+    while active_calls and time.time() < start + timeout:
+        remaining = start + timeout - time.time()
+        await asyncio.wait(list(active_calls.values()), timeout=min(5, remaining))
+        drain_state["active_calls"] = len(active_calls)
+        logger.info(f"Drain: {len(active_calls)} active calls, {max(remaining, 0):.0f}s left")
+
+    drain_state["phase"] = "closing_connections"
+    drain_state["closed_calls"] = len(pcs_map)
+    logger.info(f"Drain: closing {len(pcs_map)} connections")
+    results = await asyncio.gather(
+        *[pc.disconnect() for pc in pcs_map.values()], return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Error closing connection during drain: {result}")
+    pcs_map.clear()
+
+    drain_state["phase"] = "flushing"
+    if active_calls:
+        _, pending = await asyncio.wait(list(active_calls.values()), timeout=FLUSH_TIMEOUT_SECS)
+        if pending:
+            logger.warning(f"Drain: {len(pending)} calls did not finish flushing, cancelling")
+            for task in pending:
+                task.cancel()
+    drain_state["active_calls"] = len(active_calls)
+    await logger.complete()
+
+    drain_state["phase"] = "drained"
+    logger.info(f"Drain finished in {time.time() - start:.1f}s")
+
+
+def require_admin(request: Request):
+    """Allow admin endpoints for the admin token, or local requests not coming through a proxy."""
+    authorization = request.headers.get("authorization", "")
+    if ADMIN_TOKEN and secrets.compare_digest(
+        authorization.encode(), f"Bearer {ADMIN_TOKEN}".encode()
+    ):
+        return
+    is_loopback = request.client and request.client.host in ("127.0.0.1", "::1")
+    if is_loopback and not any(header in request.headers for header in PROXY_HEADERS):
+        return
+    raise HTTPException(status_code=403, detail="Admin token required")
+
+
+def stop_listening():
+    """Close the listening sockets, open connections are kept.
+
+    With SO_REUSEPORT the kernel then sends every new connection to the
+    server replacing this one instead of splitting them with the drainer.
+    """
+    if http_server:
+        for server in http_server.servers:
+            server.close()
+
+
+def start_drain(timeout: float) -> asyncio.Task:
+    """Start draining, or return the drain already in progress."""
+    global drain_task
+    if not drain_task:
+        drain_task = asyncio.create_task(drain(timeout))
+    return drain_task
+
 
 @app.get("/api/transcripts")
 async def list_transcripts():
@@ -93,12 +365,53 @@ async def get_transcript(filename: str):
 
 @app.get("/api/status")
 async def status():
-    return {"pcs": list(pcs_map.keys())}
+    return {"pcs": list(pcs_map.keys()), "draining": drain_state["draining"]}
+
+@app.get("/api/debug/memory", dependencies=[Depends(require_admin)])
+async def debug_memory():
+    """Per-call memory usage and objects of finished calls that are still alive.
+
+    Runs a full garbage collection first, which pauses every call for a moment.
+    """
+    return memory_report()
+
+@app.get("/api/scheduler", dependencies=[Depends(require_admin)])
+async def scheduler():
+    """Backend queueing delay and shed requests per priority class"""
+    return scheduler_report()
+
+@app.post("/api/drain", dependencies=[Depends(require_admin)])
+async def start_drain_endpoint(timeout: Optional[float] = None):
+    """Drain the server without exiting, progress is reported by GET /api/drain"""
+    start_drain(timeout if timeout is not None else DRAIN_TIMEOUT_SECS)
+    # Let the drain record its state before responding
+    await asyncio.sleep(0)
+    return drain_state
+
+@app.get("/api/drain")
+async def drain_status():
+    return drain_state
+
+@app.get("/api/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/api/ready")
+async def ready():
+    status_code = 200 if startup_state["ready"] and not drain_state["draining"] else 503
+    return JSONResponse(
+        status_code=status_code, content={**startup_state, "draining": drain_state["draining"]}
+    )
 
 @app.post("/api/offer")
-async def offer(request: dict, background_tasks: BackgroundTasks):
+async def offer(request: dict):
+    await wait_until_ready()
+
     pc_id = request.get("pc_id")
 
+    if drain_state["draining"] and not (pc_id and pc_id in pcs_map):
+        raise HTTPException(status_code=503, detail="Server is draining")
+
     if pc_id and pc_id in pcs_map:
         pipecat_connection = pcs_map[pc_id]
         logger.info(f"Reusing existing connection for pc_id: {pc_id}")
@@ -106,13 +419,17 @@ async def offer(request: dict, background_tasks: BackgroundTasks):
     else:
         pipecat_connection = SmallWebRTCConnection(ice_servers)
         await pipecat_connection.initialize(sdp=request["sdp"], type=request["type"])
+        if drain_state["draining"]:
+            # The drain started while the connection was being set up
+            await pipecat_connection.disconnect()
+            raise HTTPException(status_code=503, detail="Server is draining")
 
         @pipecat_connection.event_handler("closed")
-        async def handle_disconnected(webrtc_connection: SmallWebRTCConnection):
+        async def handle_disconnected(webrtc_connection: "SmallWebRTCConnection"):
             logger.info(f"Discarding peer connection for pc_id: {webrtc_connection.pc_id}")
             pcs_map.pop(webrtc_connection.pc_id, None)
 
-        background_tasks.add_task(run_bot, pipecat_connection)
+        start_call(pipecat_connection)
 
     answer = pipecat_connection.get_answer()
     # Updating the peer connection inside the map
@@ -124,12 +441,55 @@ async def offer(request: dict, background_tasks: BackgroundTasks):
 app.mount("/", SmallWebRTCPrebuiltUI)
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    yield  # Run app
-    coros = [pc.disconnect() for pc in pcs_map.values()]
-    await asyncio.gather(*coros)
-    pcs_map.clear()
+class DrainingServer(uvicorn.Server):
+    """Uvicorn server that drains active calls on SIGTERM/SIGINT.
+
+    Uvicorn only runs the lifespan shutdown after waiting for every open
+    request, so the drain is started from the signal instead, and the server
+    is told to exit once the drain is done. A second signal cancels the drain
+    and exits right away, without waiting for the calls.
+    """
+
+    _drain_requested = False
+
+    async def serve(self, sockets=None):
+        global http_server
+        http_server = self
+        self._loop = asyncio.get_running_loop()
+        await super().serve(sockets=sockets)
+
+    def handle_exit(self, sig, frame):
+        if not getattr(self, "_loop", None):
+            super().handle_exit(sig, frame)
+            return
+        if self._drain_requested:
+            logger.warning(f"Received signal {sig} again, exiting without finishing the drain")
+            self.force_exit = True
+            self.should_exit = True
+            self._loop.call_soon_threadsafe(self._cancel_drain)
+            return
+        self._drain_requested = True
+        logger.info(f"Received signal {sig}, draining before exit")
+        self._loop.call_soon_threadsafe(self._drain_then_exit)
+
+    async def shutdown(self, sockets=None):
+        await super().shutdown(sockets=sockets)
+        if self.force_exit:
+            # Uvicorn skips the lifespan shutdown then, which returns right
+            # away without the drain, run it so the lifespan isn't left hanging
+            await self.lifespan.shutdown()
+
+    def _drain_then_exit(self):
+        # Only when exiting, a drain through POST /api/drain keeps listening
+        # so health and drain progress can still be queried. Also covers a
+        # drain that was started through the endpoint before the signal.
+        stop_listening()
+        task = start_drain(DRAIN_TIMEOUT_SECS)
+        task.add_done_callback(lambda _: setattr(self, "should_exit", True))
+
+    def _cancel_drain(self):
+        if drain_task:
+            drain_task.cancel()
 
 
 if __name__ == "__main__":
@@ -142,44 +502,15 @@ if __name__ == "__main__":
         host = "0.0.0.0"
     
     port = int(os.getenv("PORT_WEBRTC"))
-    try:
-        # More robust port checking and process killing
-        import socket
-        import signal
-        import subprocess
-        import time
-        
-        # Check if port is in use
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex((host, port))
-        if result == 0:
-            # Port is in use, find PID
-            cmd = f"lsof -i tcp:{port} | grep LISTEN | awk '{{print $2}}'"
-            pid_output = subprocess.check_output(cmd, shell=True).decode().strip()
-            if pid_output:
-                # Kill all matching processes
-                for pid in pid_output.split('\n'):
-                    if pid:
-                        logger.info(f"Port {port} is in use by PID {pid}, attempting to kill")
-                        try:
-                            # Try SIGTERM first
-                            os.kill(int(pid), signal.SIGTERM)
-                            # Wait and check if process is still running
-                            time.sleep(1)
-                            try:
-                                os.kill(int(pid), 0)  # Check if process exists
-                                # If we get here, process still exists, use SIGKILL
-                                logger.info(f"Process {pid} still running, using SIGKILL")
-                                os.kill(int(pid), signal.SIGKILL)
-                            except OSError:
-                                pass  # Process already terminated
-                        except OSError as e:
-                            logger.warning(f"Failed to kill PID {pid}: {e}")
-                
-                # Wait to ensure port is freed
-                time.sleep(2)
-        sock.close()
-    except Exception as e:
-        logger.warning(f"Failed to check/kill port: {e}")
-    
-    uvicorn.run(app, host=host, port=port)
+
+    # SO_REUSEPORT lets a restarted server bind while the previous one is still
+    # draining, instead of killing whatever holds the port.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+
+    server = DrainingServer(uvicorn.Config(app, host=host, port=port))
+    server.run(sockets=[sock])
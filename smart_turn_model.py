@@ -0,0 +1,428 @@
+"""On-process smart-turn inference with a shared ONNX Runtime session.
+
+The model takes Whisper-style log-mel features of the last 8 seconds of a turn
+(`input_features`, shape `(batch, 80, 800)`) and returns the probability that
+the turn is complete.
+
+Features are computed incrementally: `IncrementalLogMel` turns audio into mel
+frames as it arrives, so at the end of speech only the last few frames and the
+normalization are left. Those are computed in one batch for all calls waiting
+on the model, together with a single batched `session.run`.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+
+try:
+    import onnxruntime as ort
+except ModuleNotFoundError as e:
+    logger.error(f"Exception: {e}")
+    logger.error("In order to use the local smart turn model, you need to `pip install onnxruntime`.")
+    raise Exception(f"Missing module: {e}")
+
+SAMPLE_RATE = 16000
+N_FFT = 400
+HOP_LENGTH = 160
+N_MELS = 80
+MAX_SECS = 8
+MAX_SAMPLES = MAX_SECS * SAMPLE_RATE
+MAX_FRAMES = MAX_SAMPLES // HOP_LENGTH
+# Frames whose window reaches before the start, they reflect the first samples
+HEAD_FRAMES = N_FFT // 2 // HOP_LENGTH + 1
+
+# log10 of the clipped mel power of the zero padding
+SILENCE_LOG_MEL = -10.0
+
+
+def _hz_to_mel(freqs: np.ndarray) -> np.ndarray:
+    """Slaney mel scale, as used by Whisper's feature extractor."""
+    f_sp = 200.0 / 3
+    mels = freqs / f_sp
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    return np.where(
+        freqs >= min_log_hz,
+        min_log_mel + np.log(np.maximum(freqs, min_log_hz) / min_log_hz) / logstep,
+        mels,
+    )
+
+
+def _mel_to_hz(mels: np.ndarray) -> np.ndarray:
+    f_sp = 200.0 / 3
+    freqs = f_sp * mels
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    return np.where(
+        mels >= min_log_mel, min_log_hz * np.exp(logstep * (mels - min_log_mel)), freqs
+    )
+
+
+def _mel_filters() -> np.ndarray:
+    fft_freqs = np.linspace(0, SAMPLE_RATE / 2, N_FFT // 2 + 1)
+    mel_freqs = _mel_to_hz(
+        np.linspace(_hz_to_mel(np.array(0.0)), _hz_to_mel(np.array(SAMPLE_RATE / 2)), N_MELS + 2)
+    )
+    fdiff = np.diff(mel_freqs)
+    ramps = mel_freqs[:, None] - fft_freqs[None, :]
+    lower = -ramps[:-2] / fdiff[:-1, None]
+    upper = ramps[2:] / fdiff[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    weights *= (2.0 / (mel_freqs[2 : N_MELS + 2] - mel_freqs[:N_MELS]))[:, None]
+    return weights.astype(np.float32)
+
+
+MEL_FILTERS = _mel_filters()
+# Periodic Hann window, like torch.hann_window
+WINDOW = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N_FFT) / N_FFT)).astype(np.float32)
+# Only the first two FFT bins of a Hann windowed constant are non-zero, so these
+# are the only bins affected by removing the waveform mean.
+DC_BINS = 2
+WINDOW_DC = np.fft.rfft(WINDOW)[:DC_BINS]
+
+
+def spectrum_frames(frames: np.ndarray):
+    """Compute the mel power of `(n, N_FFT)` audio windows.
+
+    Returns the mel power without the DC bins, `(n, N_MELS)`, and the complex
+    DC bins, `(n, DC_BINS)`, which are added once the mean is known.
+    """
+    if len(frames) == 0:
+        return np.zeros((0, N_MELS), dtype=np.float32), np.zeros((0, DC_BINS), dtype=np.complex64)
+    spectrum = np.fft.rfft(frames * WINDOW, axis=-1)
+    power = (spectrum.real[:, DC_BINS:] ** 2 + spectrum.imag[:, DC_BINS:] ** 2).astype(np.float32)
+    mel = power @ MEL_FILTERS[:, DC_BINS:].T
+    return mel, spectrum[:, :DC_BINS].astype(np.complex64)
+
+
+def _frame(samples: np.ndarray, num_frames: int) -> np.ndarray:
+    return np.lib.stride_tricks.sliding_window_view(samples, N_FFT)[::HOP_LENGTH][:num_frames]
+
+
+@dataclass
+class FeatureSnapshot:
+    """State of an `IncrementalLogMel` at prediction time."""
+
+    mel: np.ndarray  # (n, N_MELS) mel power of the frames computed so far, without DC bins
+    dc: np.ndarray  # (n, DC_BINS) complex DC bins of those frames
+    tail: np.ndarray  # (k, N_FFT) windows that still need the end padding
+    mean: float
+    var: float
+
+
+class IncrementalLogMel:
+    """Whisper-style log-mel features computed as audio arrives.
+
+    Frames are centered with reflect padding like Whisper's extractor. Frames
+    whose window is complete are transformed as soon as the audio is appended,
+    the last frames that need end padding are left for prediction time.
+
+    Whisper normalizes the waveform to zero mean and unit variance first. Both
+    are linear, so they are applied to the cached spectra at prediction time
+    instead: the mean only changes the DC bins and the variance scales the power.
+    Turns shorter than 8 seconds are zero padded after the normalization, in
+    the raw waveform that is padding with the mean.
+
+    Once a turn is longer than `max_secs` only its last `max_secs` are used, the
+    first frames are then recomputed to reflect the start of that window. This
+    relies on the window starting on a hop boundary, which holds for the 10 and
+    20 ms audio chunks of the transports; otherwise all frames are recomputed.
+    """
+
+    def __init__(self, max_secs: float = MAX_SECS):
+        self._max_samples = int(max_secs * SAMPLE_RATE)
+        self.reset()
+
+    @property
+    def num_samples(self) -> int:
+        return self._num_samples
+
+    def reset(self):
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._started = False
+        self._num_samples = 0
+        self._num_frames = 0
+        self._mel: deque = deque(maxlen=MAX_FRAMES)
+        self._dc: deque = deque(maxlen=MAX_FRAMES)
+        # Audio chunks covering the window, with their (count, sum, sum of
+        # squares) for the mean and variance
+        self._chunks: deque = deque()
+        self._stats: deque = deque()
+        self._stats_samples = 0
+
+    def append(self, audio: np.ndarray):
+        audio = audio.astype(np.float32, copy=False)
+        self._num_samples += len(audio)
+
+        self._chunks.append(audio)
+        self._stats.append((len(audio), float(audio.sum()), float(np.dot(audio, audio))))
+        self._stats_samples += len(audio)
+        while self._stats and self._stats_samples - self._stats[0][0] >= self._max_samples:
+            self._stats_samples -= self._stats.popleft()[0]
+            self._chunks.popleft()
+
+        self._pending = np.concatenate([self._pending, audio])
+        if not self._started:
+            if len(self._pending) <= N_FFT // 2:
+                return
+            self._pending = np.concatenate([self._pending[1 : N_FFT // 2 + 1][::-1], self._pending])
+            self._started = True
+
+        num_frames = (len(self._pending) - N_FFT) // HOP_LENGTH + 1
+        if num_frames > 0:
+            mel, dc = spectrum_frames(_frame(self._pending, num_frames))
+            self._mel.extend(mel)
+            self._dc.extend(dc)
+            self._num_frames += num_frames
+            self._pending = self._pending[num_frames * HOP_LENGTH :]
+
+    def memory_bytes(self) -> int:
+        mel = sum(row.nbytes for row in self._mel)
+        dc = sum(row.nbytes for row in self._dc)
+        chunks = sum(chunk.nbytes for chunk in self._chunks)
+        return mel + dc + chunks + self._pending.nbytes
+
+    def snapshot(self) -> FeatureSnapshot:
+        window_samples = min(self._num_samples, self._max_samples)
+        window_start = self._num_samples - window_samples
+        if window_start % HOP_LENGTH:
+            # The cached frames are not aligned with the frames of the window
+            features = IncrementalLogMel(max_secs=self._max_samples / SAMPLE_RATE)
+            features.append(self._window_audio(window_start))
+            return features.snapshot()
+
+        # Mean and variance of the window, the oldest chunk can start before it
+        count = self._stats_samples
+        total = sum(s[1] for s in self._stats)
+        squares = sum(s[2] for s in self._stats)
+        excess = count - window_samples
+        if excess > 0:
+            head = self._chunks[0][:excess]
+            count -= excess
+            total -= float(head.sum())
+            squares -= float(np.dot(head, head))
+        mean = var = 0.0
+        if count:
+            mean = total / count
+            var = max(squares / count - mean * mean, 0.0)
+
+        # Whisper produces the frames of the padded 8 seconds minus the last one,
+        # frames past the audio are silence and are filled in by finalize_features
+        first_frame = window_start // HOP_LENGTH
+        num_frames = min(MAX_FRAMES, (window_samples + N_FFT // 2 - 1) // HOP_LENGTH + 1)
+        num_tail = max(0, first_frame + num_frames - self._num_frames)
+        tail = np.zeros((0, N_FFT), dtype=np.float32)
+        if num_tail:
+            # Zero padding of the normalized waveform, then the end reflection
+            # once the padding reaches the end of the 8 seconds
+            pad = min(MAX_SAMPLES - window_samples, N_FFT)
+            samples = np.concatenate([self._pending, np.full(pad, mean, dtype=np.float32)])
+            if not self._started:
+                samples = np.concatenate([samples[1 : N_FFT // 2 + 1][::-1], samples])
+            if window_samples + pad == MAX_SAMPLES:
+                samples = np.concatenate([samples, samples[-(N_FFT // 2 + 1) : -1][::-1]])
+            tail = _frame(samples, num_tail).copy()
+
+        cached_first = self._num_frames - len(self._mel)
+        skip = max(0, first_frame - cached_first)
+        mel = np.array(self._mel, dtype=np.float32).reshape(-1, N_MELS)[skip:]
+        dc = np.array(self._dc, dtype=np.complex64).reshape(-1, DC_BINS)[skip:]
+        if window_start and len(mel) >= HEAD_FRAMES:
+            # The first frames reflect the start of the window, not the audio before it
+            head = self._window_audio(window_start, N_FFT)
+            head = np.concatenate([head[1 : N_FFT // 2 + 1][::-1], head])
+            mel[:HEAD_FRAMES], dc[:HEAD_FRAMES] = spectrum_frames(_frame(head, HEAD_FRAMES))
+
+        return FeatureSnapshot(mel=mel, dc=dc, tail=tail, mean=mean, var=var)
+
+    def _window_audio(self, window_start: int, length: Optional[int] = None) -> np.ndarray:
+        """Audio of the window from `window_start`, the first `length` samples if given."""
+        offset = window_start - (self._num_samples - self._stats_samples)
+        chunks = []
+        size = 0
+        for chunk in self._chunks:
+            chunks.append(chunk)
+            size += len(chunk)
+            if length is not None and size >= offset + length:
+                break
+        audio = np.concatenate(chunks)[offset:]
+        return audio if length is None else audio[:length]
+
+
+def finalize_features(mel: np.ndarray, dc: np.ndarray, mean: float, var: float) -> np.ndarray:
+    """Turn cached spectra into the `(N_MELS, MAX_FRAMES)` model input."""
+    mel = mel[-MAX_FRAMES:]
+    dc = dc[-MAX_FRAMES:] - mean * WINDOW_DC
+    mel = mel + (dc.real**2 + dc.imag**2) @ MEL_FILTERS[:, :DC_BINS].T
+    log_mel = np.log10(np.maximum(mel / (var + 1e-7), 1e-10))
+
+    # Shorter turns are padded with silence at the end, like Whisper's extractor.
+    features = np.full((MAX_FRAMES, N_MELS), SILENCE_LOG_MEL, dtype=np.float32)
+    features[: len(log_mel)] = log_mel
+    features = np.maximum(features, features.max() - 8.0)
+    return ((features + 4.0) / 4.0).T
+
+
+def batch_features(snapshots: List[FeatureSnapshot]) -> np.ndarray:
+    """Model input for a batch of snapshots, `(batch, N_MELS, MAX_FRAMES)`."""
+    # Finish the tail frames of every call with one FFT and mel projection
+    tail_mel, tail_dc = spectrum_frames(np.concatenate([s.tail for s in snapshots]))
+    features = []
+    offset = 0
+    for snapshot in snapshots:
+        end = offset + len(snapshot.tail)
+        features.append(
+            finalize_features(
+                np.concatenate([snapshot.mel, tail_mel[offset:end]]),
+                np.concatenate([snapshot.dc, tail_dc[offset:end]]),
+                snapshot.mean,
+                snapshot.var,
+            )
+        )
+        offset = end
+    return np.stack(features).astype(np.float32)
+
+
+class SmartTurnOnnxModel:
+    """Smart-turn ONNX model shared by every call in the process.
+
+    Concurrent predictions are collected for up to `batch_window_secs` and run
+    as one batch on a single worker thread.
+    """
+
+    def __init__(self, model_path: str, max_batch_size: int = 8, batch_window_secs: float = 0.005):
+        logger.debug(f"Loading smart turn ONNX model from {model_path}...")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self._input_name = self._session.get_inputs()[0].name
+        self._max_batch_size = max_batch_size
+        self._batch_window_secs = batch_window_secs
+        self._batch_supported = True
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smart-turn")
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        logger.debug("Loaded smart turn ONNX model")
+
+    async def predict(self, snapshot: FeatureSnapshot) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or not self._batch_task or self._batch_task.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._batch_task = loop.create_task(self._batch_task_handler())
+
+        future = loop.create_future()
+        await self._queue.put((snapshot, future))
+        return await future
+
+    async def _batch_task_handler(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._batch_window_secs
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            snapshots = [snapshot for snapshot, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self._run_batch, snapshots)
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, snapshots: List[FeatureSnapshot]) -> List[Dict[str, Any]]:
+        start_time = time.perf_counter()
+        features = batch_features(snapshots)
+
+        inference_start = time.perf_counter()
+        probabilities = self._run_session(features)
+        end_time = time.perf_counter()
+
+        inference_time = (end_time - inference_start) / len(snapshots)
+        total_time = end_time - start_time
+        return [
+            {
+                "prediction": 1 if probability > 0.5 else 0,
+                "probability": float(probability),
+                "metrics": {"inference_time": inference_time, "total_time": total_time},
+            }
+            for probability in probabilities
+        ]
+
+    def _run_session(self, features: np.ndarray) -> np.ndarray:
+        if self._batch_supported or len(features) == 1:
+            try:
+                return self._probabilities(self._session.run(None, {self._input_name: features})[0])
+            except Exception as e:
+                if len(features) == 1:
+                    raise
+                logger.warning(f"Smart turn model does not support batching, running one by one: {e}")
+                self._batch_supported = False
+
+        return np.concatenate(
+            [
+                self._probabilities(self._session.run(None, {self._input_name: f[None]})[0])
+                for f in features
+            ]
+        )
+
+    def _probabilities(self, output: np.ndarray) -> np.ndarray:
+        output = output.reshape(output.shape[0], -1)
+        if output.shape[1] == 2:
+            # Two class logits, probability of "complete"
+            exp = np.exp(output - output.max(axis=1, keepdims=True))
+            return exp[:, 1] / exp.sum(axis=1)
+        return output[:, 0]
+
+
+_shared_models: Dict[str, SmartTurnOnnxModel] = {}
+# Load error per model path, a model that failed to load is not loaded again
+_failed_models: Dict[str, str] = {}
+_shared_models_lock = threading.Lock()
+
+
+def get_shared_model(model_path: str) -> SmartTurnOnnxModel:
+    """Return the process-wide model for `model_path`, loading it on first use.
+
+    Loading blocks, so it is done once at startup. If it fails the error is
+    recorded and raised again on later calls without retrying the load.
+    """
+    with _shared_models_lock:
+        if model_path in _failed_models:
+            raise RuntimeError(f"Smart turn model failed to load: {_failed_models[model_path]}")
+        if model_path not in _shared_models:
+            try:
+                _shared_models[model_path] = SmartTurnOnnxModel(model_path)
+            except Exception as e:
+                _failed_models[model_path] = str(e)
+                raise
+        return _shared_models[model_path]
+
+
+def loaded_model(model_path: str) -> Optional[SmartTurnOnnxModel]:
+    """Return the model for `model_path` if it is loaded, without loading it."""
+    with _shared_models_lock:
+        return _shared_models.get(model_path)
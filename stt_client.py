@@ -1,7 +1,83 @@
-from typing import Optional
+import io
+import wave
+from typing import AsyncGenerator, Optional
+
+from loguru import logger
+from pipecat.frames.frames import (
+    AudioRawFrame,
+    ErrorFrame,
+    Frame,
+    StartFrame,
+    UserStoppedSpeakingFrame,
+)
+from pipecat.processors.frame_processor import FrameDirection
 from pipecat.services.whisper.base_stt import BaseWhisperSTTService, Transcription
 from pipecat.transcriptions.language import Language
 
+from call_memory import AUDIO_BUFFER_POOL
+from scheduler import DEADLINE_SECS, Priority, RequestShed, get_backend
+
+# Longest utterance kept for transcription, older audio is dropped
+MAX_UTTERANCE_SECS = 30
+
+
+class RingAudioBuffer:
+    """Bounded audio buffer on top of a fixed-size bytearray.
+
+    Writes past the capacity overwrite the oldest audio, trimming only moves
+    the start offset, so the buffer is never reallocated.
+    """
+
+    def __init__(self, buffer: bytearray):
+        self.buffer = buffer
+        self._capacity = len(buffer)
+        self._start = 0
+        self._length = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def write(self, data: bytes):
+        size = len(data)
+        if size >= self._capacity:
+            self.dropped += self._length + size - self._capacity
+            self.buffer[:] = data[size - self._capacity :]
+            self._start = 0
+            self._length = self._capacity
+            return
+
+        end = (self._start + self._length) % self._capacity
+        first = min(size, self._capacity - end)
+        self.buffer[end : end + first] = data[:first]
+        self.buffer[: size - first] = data[first:]
+
+        overflow = self._length + size - self._capacity
+        if overflow > 0:
+            self._start = (self._start + overflow) % self._capacity
+            self._length = self._capacity
+            self.dropped += overflow
+        else:
+            self._length += size
+
+    def trim(self, keep: int):
+        """Keep only the last `keep` bytes."""
+        if self._length > keep:
+            self._start = (self._start + self._length - keep) % self._capacity
+            self._length = keep
+
+    def getvalue(self) -> bytes:
+        end = self._start + self._length
+        if end <= self._capacity:
+            return bytes(self.buffer[self._start : end])
+        return bytes(self.buffer[self._start :]) + bytes(self.buffer[: end - self._capacity])
+
+    def clear(self):
+        self._start = 0
+        self._length = 0
+        self.dropped = 0
+
+
 class CustomSTTService(BaseWhisperSTTService):
     def __init__(
         self,
@@ -12,6 +88,7 @@ class CustomSTTService(BaseWhisperSTTService):
         language: Optional[Language] = Language.EN,
         prompt: Optional[str] = None,
         temperature: Optional[float] = None,
+        call_id: Optional[str] = None,
         **kwargs,
     ):
         super().__init__(
@@ -23,6 +100,71 @@ class CustomSTTService(BaseWhisperSTTService):
             temperature=temperature,
             **kwargs,
         )
+        self._utterance: Optional[RingAudioBuffer] = None
+        self._call_id = call_id or self.name
+
+    async def start(self, frame: StartFrame):
+        await super().start(frame)
+        if self._utterance is None:
+            size = MAX_UTTERANCE_SECS * self.sample_rate * 2
+            self._utterance = RingAudioBuffer(AUDIO_BUFFER_POOL.acquire(size))
+
+    async def cleanup(self):
+        await super().cleanup()
+        if self._utterance is not None:
+            AUDIO_BUFFER_POOL.release(self._utterance.buffer)
+            self._utterance = None
+
+    def memory_bytes(self) -> int:
+        return len(self._utterance.buffer) if self._utterance is not None else 0
+
+    async def process_audio_frame(self, frame: AudioRawFrame, direction: FrameDirection):
+        # Same as SegmentedSTTService, but buffering into the bounded pooled
+        # buffer instead of an ever growing bytearray.
+        self._user_id = getattr(frame, "user_id", "")
+        if self._utterance is None:
+            return
+
+        self._utterance.write(frame.audio)
+
+        # If the user is not speaking we keep just a little bit of audio.
+        if not self._user_speaking:
+            self._utterance.trim(self._audio_buffer_size_1s)
+
+    async def _handle_user_stopped_speaking(self, frame: UserStoppedSpeakingFrame):
+        if frame.emulated or self._utterance is None:
+            return
+
+        self._user_speaking = False
+
+        if self._utterance.dropped:
+            logger.warning(
+                f"{self}: utterance longer than {MAX_UTTERANCE_SECS}s, transcribing the last {MAX_UTTERANCE_SECS}s"
+            )
+
+        content = io.BytesIO()
+        wav = wave.open(content, "wb")
+        wav.setsampwidth(2)
+        wav.setnchannels(1)
+        wav.setframerate(self.sample_rate)
+        wav.writeframes(self._utterance.getvalue())
+        wav.close()
+        content.seek(0)
+
+        # Start clean.
+        self._utterance.clear()
+
+        await self.process_generator(self.run_stt(content.read()))
+
+    async def run_stt(self, audio: bytes) -> AsyncGenerator[Frame, None]:
+        try:
+            async with get_backend("stt").slot(
+                Priority.STT, self._call_id, DEADLINE_SECS[Priority.STT]
+            ):
+                async for frame in super().run_stt(audio):
+                    yield frame
+        except RequestShed as e:
+            yield ErrorFrame(f"Transcription shed: {e}")
 
     async def _transcribe(self, audio: bytes) -> Transcription:
         assert self._language is not None  # Assigned in the BaseWhisperSTTService class
@@ -6,14 +6,19 @@ from openai import AsyncOpenAI, BadRequestError
 from pipecat.frames.frames import (
     ErrorFrame,
     Frame,
+    LLMFullResponseStartFrame,
     StartFrame,
     TTSAudioRawFrame,
     TTSStartedFrame,
+    TTSSpeakFrame,
     TTSStoppedFrame,
 )
+from pipecat.processors.frame_processor import FrameDirection
 from pipecat.services.tts_service import TTSService
 from pipecat.utils.tracing.service_decorators import traced_tts
 
+from scheduler import DEADLINE_SECS, Priority, RequestShed, get_backend
+
 
 class CustomTTSService(TTSService):
     OPENAI_SAMPLE_RATE = 24000
@@ -26,6 +31,7 @@ class CustomTTSService(TTSService):
         model: str = "",
         sample_rate: Optional[int] = None,
         instructions: Optional[str] = None,
+        call_id: Optional[str] = None,
         **kwargs,
     ):
         if sample_rate and sample_rate != self.OPENAI_SAMPLE_RATE:
@@ -38,6 +44,10 @@ class CustomTTSService(TTSService):
         self.set_voice("")
         self._instructions = instructions
         self._client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        self._call_id = call_id or self.name
+        # The caller is waiting for the first clause of a response, the rest
+        # is synthesized ahead of playback
+        self._first_clause = True
 
     def can_generate_metrics(self) -> bool:
         return True
@@ -53,8 +63,23 @@ class CustomTTSService(TTSService):
                 f"Current rate of {self.sample_rate}Hz may cause issues."
             )
 
+    async def process_frame(self, frame: Frame, direction: FrameDirection):
+        if isinstance(frame, (LLMFullResponseStartFrame, TTSSpeakFrame)):
+            self._first_clause = True
+        await super().process_frame(frame, direction)
+
     @traced_tts
     async def run_tts(self, text: str) -> AsyncGenerator[Frame, None]:
+        priority = Priority.TTS_FIRST_CLAUSE if self._first_clause else Priority.TTS_PREFETCH
+        self._first_clause = False
+        try:
+            async with get_backend("tts").slot(priority, self._call_id, DEADLINE_SECS[priority]):
+                async for frame in self._synthesize(text):
+                    yield frame
+        except RequestShed as e:
+            yield ErrorFrame(f"TTS shed: {e}")
+
+    async def _synthesize(self, text: str) -> AsyncGenerator[Frame, None]:
         logger.debug(f"{self}: Generating TTS [{text}]")
         try:
             await self.start_ttfb_metrics()
@@ -1,5 +1,17 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional, Tuple
+
 import aiohttp
+import numpy as np
+from loguru import logger
+from pipecat.audio.turn.base_turn_analyzer import EndOfTurnState
+from pipecat.audio.turn.smart_turn.base_smart_turn import SmartTurnTimeoutException
 from pipecat.audio.turn.smart_turn.http_smart_turn import HttpSmartTurnAnalyzer
+from pipecat.metrics.metrics import MetricsData
+
+from scheduler import DEADLINE_SECS, Priority, RequestShed, get_backend
+from turn_controller import AdaptiveTurnController
 
 class CustomSmartTurnAnalyzer(HttpSmartTurnAnalyzer):
     def __init__(
@@ -7,7 +19,154 @@ class CustomSmartTurnAnalyzer(HttpSmartTurnAnalyzer):
         *,
         aiohttp_session: aiohttp.ClientSession,
         base_url: str,
+        turn_controller: Optional[AdaptiveTurnController] = None,
+        call_id: Optional[str] = None,
         **kwargs,
     ):
         url = f"{base_url}/audio/turn-detect"
-        super().__init__(url=url, aiohttp_session=aiohttp_session, headers={}, **kwargs)
\ No newline at end of file
+        super().__init__(url=url, aiohttp_session=aiohttp_session, headers={}, **kwargs)
+        self._turn_controller = turn_controller
+        self._call_id = call_id or str(id(self))
+
+    def append_audio(self, buffer: bytes, is_speech: bool) -> EndOfTurnState:
+        if self._turn_controller:
+            duration_secs = len(buffer) / 2 / self.sample_rate
+            self._turn_controller.append_audio(duration_secs)
+
+        state = super().append_audio(buffer, is_speech)
+        if self._speech_triggered:
+            self._trim_audio_buffer()
+
+        # Turn ended by the stop_secs silence fallback, without a smart-turn result
+        if self._turn_controller and state == EndOfTurnState.COMPLETE:
+            self._turn_controller.on_turn_end()
+        return state
+
+    def memory_bytes(self) -> int:
+        return sum(chunk.nbytes for _, chunk in self._audio_buffer)
+
+    def _trim_audio_buffer(self):
+        # BaseSmartTurn only trims before speech starts, a caller speaking
+        # without long enough pauses would grow the buffer for the whole turn.
+        # Only the last max_duration_secs are ever sent to the model.
+        max_buffer_time = (
+            (self._params.pre_speech_ms / 1000)
+            + self._params.stop_secs
+            + self._params.max_duration_secs
+        )
+        cutoff = time.time() - max_buffer_time
+        expired = 0
+        while expired < len(self._audio_buffer) and self._audio_buffer[expired][0] < cutoff:
+            expired += 1
+        if expired:
+            del self._audio_buffer[:expired]
+
+    async def analyze_end_of_turn(self) -> Tuple[EndOfTurnState, Optional[MetricsData]]:
+        state, result = await super().analyze_end_of_turn()
+        if self._turn_controller and state == EndOfTurnState.COMPLETE:
+            if result:
+                self._turn_controller.on_turn_end(
+                    probability=result.probability,
+                    decision_secs=result.e2e_processing_time_ms / 1000,
+                )
+            else:
+                # Turn-detect timed out, which counts as complete
+                self._turn_controller.on_turn_end()
+        return state, result
+
+    async def _predict_endpoint(self, audio_array: np.ndarray) -> Dict[str, Any]:
+        if not self._turn_controller:
+            return await self._predict_with_model(audio_array)
+
+        local_result = self._turn_controller.local_prediction()
+        if local_result:
+            return local_result
+
+        start_time = time.perf_counter()
+        result = await self._predict_with_model(audio_array)
+        self._turn_controller.on_remote_prediction(time.perf_counter() - start_time)
+        return result
+
+    async def _predict_with_model(self, audio_array: np.ndarray) -> Dict[str, Any]:
+        """Run the smart-turn model, here through the remote turn-detect endpoint."""
+        # Turn-detect runs on the STT server. Past stop_secs the answer is
+        # useless, the turn ends on silence anyway, so the wait for a slot and
+        # the request share that budget.
+        budget_secs = self._params.stop_secs
+        start_time = time.monotonic()
+        try:
+            async with get_backend("stt").slot(
+                Priority.TURN_DETECT,
+                self._call_id,
+                min(DEADLINE_SECS[Priority.TURN_DETECT], budget_secs),
+            ):
+                remaining_secs = budget_secs - (time.monotonic() - start_time)
+                return await asyncio.wait_for(
+                    self._request_prediction(audio_array), timeout=max(remaining_secs, 0.0)
+                )
+        except RequestShed as e:
+            raise SmartTurnTimeoutException(str(e))
+        except asyncio.TimeoutError:
+            raise SmartTurnTimeoutException(f"Turn-detect exceeded {budget_secs} seconds")
+
+    async def _request_prediction(self, audio_array: np.ndarray) -> Dict[str, Any]:
+        return await super()._predict_endpoint(audio_array)
+
+
+class LocalSmartTurnAnalyzer(CustomSmartTurnAnalyzer):
+    """Smart turn analyzer running the ONNX model in process.
+
+    The model session is shared by every call in the process and the audio
+    features are computed incrementally while the caller speaks. The model is
+    loaded once at server startup, the remote turn-detect endpoint is used if
+    it wasn't loaded or fails.
+    """
+
+    def __init__(self, *, model_path: str, **kwargs):
+        super().__init__(**kwargs)
+
+        # Imported here so onnxruntime is only loaded when the local model is used
+        from smart_turn_model import SAMPLE_RATE, IncrementalLogMel, loaded_model
+
+        self._model_sample_rate = SAMPLE_RATE
+        self._features = IncrementalLogMel(max_secs=self._params.max_duration_secs)
+        # Never load here, that would block the event loop for every call
+        self._model = loaded_model(model_path)
+        if not self._model:
+            logger.debug("Smart turn model is not loaded, using turn-detect endpoint")
+
+    def append_audio(self, buffer: bytes, is_speech: bool) -> EndOfTurnState:
+        # Mirror the audio BaseSmartTurn keeps for the next prediction, only
+        # if the model can run on it
+        if self._model_usable() and (is_speech or self._speech_triggered):
+            audio = np.frombuffer(buffer, dtype=np.int16).astype(np.float32) / 32768.0
+            self._features.append(audio)
+        return super().append_audio(buffer, is_speech)
+
+    def _clear(self, turn_state: EndOfTurnState):
+        super()._clear(turn_state)
+        self._features.reset()
+
+    def memory_bytes(self) -> int:
+        return super().memory_bytes() + self._features.memory_bytes()
+
+    def _model_usable(self) -> bool:
+        return self._model is not None and self.sample_rate == self._model_sample_rate
+
+    async def _predict_with_model(self, audio_array: np.ndarray) -> Dict[str, Any]:
+        if self._model_usable():
+            features = self._features
+            # The cache can miss a chunk around the start of speech, only
+            # recompute from scratch if it is really out of sync.
+            max_samples = int(self._params.max_duration_secs * self.sample_rate)
+            if abs(min(features.num_samples, max_samples) - len(audio_array)) > self.sample_rate // 10:
+                from smart_turn_model import IncrementalLogMel
+
+                features = IncrementalLogMel(max_secs=self._params.max_duration_secs)
+                features.append(audio_array)
+            try:
+                return await self._model.predict(features.snapshot())
+            except Exception as e:
+                logger.error(f"Local smart turn prediction failed, using turn-detect endpoint: {e}")
+
+        return await super()._predict_with_model(audio_array)
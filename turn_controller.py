@@ -0,0 +1,249 @@
+"""Adaptive end-of-turn timing learned per call.
+
+The controller follows the caller's audio as the smart turn analyzer sees it
+and learns two things:
+
+- how long the caller pauses in the middle of a turn, which sets the VAD
+  `stop_secs` (the silence needed before smart-turn is consulted), and
+- how likely a pause of a given length is to end the turn, from smart-turn
+  probabilities and from the pauses the caller resumed speaking after. When
+  that likelihood is high enough the remote turn-detect request is skipped.
+  Turns ended without a smart-turn result, skipped ones included, are not
+  learned from, or skipping would keep confirming itself.
+
+All durations are measured on the audio clock, so replays at any speed learn
+the same thing.
+"""
+
+import statistics
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+from pipecat.audio.vad.vad_analyzer import VADAnalyzer, VADState
+
+# Pauses within this distance are considered the same length
+PAUSE_TOLERANCE_SECS = 0.05
+
+
+class AdaptiveTurnParams(BaseModel):
+    """Configuration for the adaptive end-of-turn controller.
+
+    Parameters:
+        min_stop_secs: Lower bound for the VAD stop threshold, shorter
+            silences are not learned as pauses.
+        max_stop_secs: Upper bound for the VAD stop threshold.
+        pause_quantile: Quantile of mid-turn pauses the stop threshold covers.
+        margin_secs: Silence added on top of that quantile.
+        min_pauses: Mid-turn pauses observed before the threshold adapts.
+        min_turns_for_skip: Turns observed before turn-detect may be skipped.
+        skip_confidence: Local end-of-turn confidence needed to skip turn-detect.
+        false_cut_window_secs: Speech this soon after an end of turn means the
+            caller was cut off.
+        history_size: Number of pauses remembered.
+    """
+
+    min_stop_secs: float = 0.2
+    max_stop_secs: float = 1.0
+    pause_quantile: float = 0.9
+    margin_secs: float = 0.1
+    min_pauses: int = 5
+    min_turns_for_skip: int = 3
+    skip_confidence: float = 0.9
+    false_cut_window_secs: float = 1.0
+    history_size: int = 200
+
+
+class AdaptiveTurnController:
+    """Learns a caller's pauses and tunes VAD stop time and turn-detect usage."""
+
+    def __init__(self, *, vad_analyzer: VADAnalyzer, params: Optional[AdaptiveTurnParams] = None):
+        self._vad_analyzer = vad_analyzer
+        self._params = params or AdaptiveTurnParams()
+        self._baseline_stop_secs = vad_analyzer.params.stop_secs
+        self._stop_secs = self._baseline_stop_secs
+
+        # [pause_secs, probability the pause ended the turn]
+        self._observations: deque = deque(maxlen=self._params.history_size)
+        self._mid_pauses: deque = deque(maxlen=self._params.history_size)
+        # Same for the last turn end, the probability is None if not observed
+        self._last_turn_end: Optional[List[Optional[float]]] = None
+        self._turn_detect_skipped = False
+
+        self._in_turn = False
+        self._silence_secs = 0.0
+        self._starting_secs = 0.0
+        self._since_turn_end: Optional[float] = None
+
+        self._turns = 0
+        self._false_cuts = 0
+        self._remote_requests = 0
+        self._skipped_requests = 0
+        self._mid_pauses_over_baseline = 0
+        self._turn_latencies: deque = deque(maxlen=self._params.history_size)
+        self._remote_latencies: deque = deque(maxlen=self._params.history_size)
+
+    @property
+    def stop_secs(self) -> float:
+        return self._stop_secs
+
+    def append_audio(self, duration_secs: float):
+        """Track speech and silence runs for an audio chunk the VAD just analyzed.
+
+        The speech flag the turn analyzer gets stays set until the VAD
+        stop_secs have passed, so pauses shorter than that would never be
+        seen. The runs follow the VAD's own state instead.
+        """
+        state = self._vad_analyzer._vad_state
+        if state == VADState.STARTING:
+            # Speech began here if the VAD confirms it, silence otherwise
+            self._starting_secs += duration_secs
+            return
+        is_speech = state == VADState.SPEAKING
+        if not is_speech:
+            duration_secs += self._starting_secs
+        self._starting_secs = 0.0
+
+        if is_speech:
+            self._turn_detect_skipped = False
+            if self._since_turn_end is not None:
+                self._handle_false_cut()
+            elif self._in_turn and self._silence_secs > 0:
+                self._add_mid_pause(self._silence_secs)
+            self._in_turn = True
+            self._silence_secs = 0.0
+        elif self._in_turn:
+            self._silence_secs += duration_secs
+        elif self._since_turn_end is not None:
+            self._since_turn_end += duration_secs
+            if self._since_turn_end > self._params.false_cut_window_secs:
+                self._since_turn_end = None
+
+    def local_prediction(self) -> Optional[Dict[str, Any]]:
+        """Return an end-of-turn prediction if the remote request can be skipped.
+
+        The result uses the same format as the turn-detect response so it goes
+        through the regular smart turn metrics path.
+        """
+        confidence = self._end_of_turn_confidence(self._silence_secs)
+        if self._turns >= self._params.min_turns_for_skip and confidence >= self._params.skip_confidence:
+            self._skipped_requests += 1
+            self._turn_detect_skipped = True
+            logger.debug(
+                f"Skipping turn-detect, local confidence {confidence:.2f} after {self._silence_secs:.2f}s"
+            )
+            return {
+                "prediction": 1,
+                "probability": confidence,
+                "metrics": {"inference_time": 0.0, "total_time": 0.0},
+            }
+        self._remote_requests += 1
+        return None
+
+    def on_remote_prediction(self, latency_secs: float):
+        self._remote_latencies.append(latency_secs)
+
+    def on_turn_end(self, probability: Optional[float] = None, decision_secs: float = 0.0):
+        """Record that the turn was declared complete after the current pause.
+
+        `probability` is the smart-turn result the turn ended on, None if it
+        ended without one (silence fallback, turn-detect timeout). It is only
+        learned from if turn-detect really ran, not when it was skipped.
+        """
+        pause = self._silence_secs
+        if self._turn_detect_skipped:
+            probability = None
+        self._last_turn_end = [pause, probability]
+        if probability is not None:
+            self._observations.append(self._last_turn_end)
+        self._turn_detect_skipped = False
+        self._turns += 1
+        self._turn_latencies.append(pause + decision_secs)
+
+        self._in_turn = False
+        self._silence_secs = 0.0
+        self._since_turn_end = 0.0
+        self._update_stop_secs()
+
+    def report(self) -> Dict[str, Any]:
+        """Summarize the call against the fixed stop threshold baseline.
+
+        The baseline would have sent turn-detect for every turn and every
+        mid-turn pause that reached its stop threshold, each of them a chance
+        to cut the caller off. The baseline is estimated from this call, use
+        `replay.py turn-compare` to measure both on the same capture.
+        """
+        remote_latency = (
+            statistics.fmean(self._remote_latencies) if self._remote_latencies else 0.0
+        )
+        return {
+            "turns": self._turns,
+            "false_cuts": self._false_cuts,
+            "false_cut_rate": self._false_cuts / self._turns if self._turns else 0.0,
+            "stop_secs": self._stop_secs,
+            "turn_latency_ms": (
+                statistics.fmean(self._turn_latencies) * 1000 if self._turn_latencies else 0.0
+            ),
+            "turn_detect_requests": self._remote_requests,
+            "turn_detect_skipped": self._skipped_requests,
+            "baseline": {
+                "stop_secs": self._baseline_stop_secs,
+                "turn_latency_ms": (self._baseline_stop_secs + remote_latency) * 1000,
+                "turn_detect_requests": self._turns + self._mid_pauses_over_baseline,
+                "mid_turn_pauses_at_risk": self._mid_pauses_over_baseline,
+            },
+        }
+
+    def _add_mid_pause(self, pause: float):
+        if pause >= self._baseline_stop_secs:
+            self._mid_pauses_over_baseline += 1
+        # Shorter gaps are VAD flicker within a word, not pauses, and would
+        # pull both the stop threshold and the skip confidence down.
+        if pause < self._params.min_stop_secs:
+            return
+        self._observations.append([pause, 0.0])
+        self._mid_pauses.append(pause)
+
+    def _handle_false_cut(self):
+        # The caller kept talking, so the pause we ended the turn on was a
+        # mid-turn pause.
+        self._false_cuts += 1
+        self._since_turn_end = None
+        if self._last_turn_end:
+            # Resuming is an observation even if the turn end was not
+            if self._last_turn_end[1] is None:
+                self._observations.append(self._last_turn_end)
+            self._last_turn_end[1] = 0.0
+            self._mid_pauses.append(self._last_turn_end[0])
+            self._last_turn_end = None
+        # The stop threshold is updated at the next end of turn, changing VAD
+        # params now would reset it while the caller is speaking.
+
+    def _end_of_turn_confidence(self, pause: float) -> float:
+        # Smoothed share of pauses at least this long that ended the turn
+        probabilities = [
+            p for secs, p in self._observations if secs >= pause - PAUSE_TOLERANCE_SECS
+        ]
+        return (sum(probabilities) + 1) / (len(probabilities) + 2)
+
+    def _update_stop_secs(self):
+        if len(self._mid_pauses) < self._params.min_pauses:
+            return
+
+        pauses = sorted(self._mid_pauses)
+        index = min(len(pauses) - 1, int(len(pauses) * self._params.pause_quantile))
+        stop_secs = min(
+            max(pauses[index] + self._params.margin_secs, self._params.min_stop_secs),
+            self._params.max_stop_secs,
+        )
+        if abs(stop_secs - self._stop_secs) < PAUSE_TOLERANCE_SECS:
+            return
+
+        logger.debug(f"Adapting VAD stop_secs from {self._stop_secs:.2f} to {stop_secs:.2f}")
+        self._stop_secs = stop_secs
+        # Only called between turns, when resetting the VAD state is harmless.
+        self._vad_analyzer.set_params(
+            self._vad_analyzer.params.model_copy(update={"stop_secs": stop_secs})
+        )